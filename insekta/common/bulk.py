@@ -0,0 +1,52 @@
+from django.db import connection, transaction
+
+# SQLite allows at most 999 parameters in a statement
+SQLITE_MAX_PARAMS = 999
+
+def insert_many(model, columns, rows, batch_size=1000):
+    """Insert rows into the table of a model with multi-row INSERTs.
+
+    No model instances are created and no signals are sent. The rows are
+    part of the current transaction, outside of transaction management
+    they are committed.
+
+    :param model: The model class.
+    :param columns: List of column names.
+    :param rows: List of tuples with a value for each column.
+    :param batch_size: Maximum number of rows in a statement.
+    """
+    if connection.vendor == 'sqlite':
+        batch_size = min(batch_size, SQLITE_MAX_PARAMS // len(columns))
+    table = connection.ops.quote_name(model._meta.db_table)
+    column_list = ', '.join(connection.ops.quote_name(column)
+                            for column in columns)
+    row_sql = '({0})'.format(', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    for offset in xrange(0, len(rows), batch_size):
+        batch = rows[offset:offset + batch_size]
+        params = []
+        for row in batch:
+            params.extend(row)
+        cursor.execute('INSERT INTO {0} ({1}) VALUES {2}'.format(table,
+                column_list, ', '.join([row_sql] * len(batch))), params)
+    transaction.commit_unless_managed()
+
+def filter_many(query_set, field, values, batch_size=1000):
+    """Return the results of a query set whose field is in a list of values.
+
+    Long lists are split into several queries, so SQLite's limit of
+    parameters is not exceeded.
+
+    :param query_set: The query set, e.g. with ``values_list`` applied.
+    :param field: Name of the field, ``__in`` is appended.
+    :param values: List of values.
+    :param batch_size: Maximum number of values in a query.
+    """
+    if connection.vendor == 'sqlite':
+        batch_size = min(batch_size, SQLITE_MAX_PARAMS)
+    results = []
+    lookup = field + '__in'
+    for offset in xrange(0, len(values), batch_size):
+        results.extend(query_set.filter(**{lookup: values[offset:offset +
+                                                           batch_size]}))
+    return results
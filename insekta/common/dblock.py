@@ -1,30 +1,192 @@
-from django.db import connection
+"""Advisory locks of PostgreSQL.
+
+A lock is identified by a lock type and the pk of the locked object, so
+locks on different objects don't wait for each other. Every process counts
+how often and how long it waited for and held each lock type, see
+:data:`lock_stats`. Long waits and timeouts are logged to the logger
+``insekta.dblock``, with the pids of the holders on timeouts, and so are
+the statistics every ``DBLOCK_STATS_INTERVAL`` seconds.
+"""
+import os
+import time
+import logging
+import threading
+
+from django.db import connection, DatabaseError
+from django.conf import settings
+
+logger = logging.getLogger('insekta.dblock')
+
+class LockTimeout(Exception):
+    pass
+
+class LockStats(object):
+    """Thread-safe statistics of the locks taken by this process.
+
+    The statistics are kept in the memory of the process, so every
+    gunicorn worker and every vmd has its own. They are logged with the
+    pid every `log_interval` seconds, when a lock is used.
+    """
+    def __init__(self, log_interval=None):
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._next_log = time.time() + (log_interval or 0)
+
+    def record_wait(self, lock_type, wait_time, timed_out=False):
+        with self._lock:
+            stats = self._get(lock_type)
+            stats['timeouts' if timed_out else 'acquired'] += 1
+            stats['wait_time'] += wait_time
+            stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+        self._log_periodically()
+
+    def record_hold(self, lock_type, hold_time):
+        with self._lock:
+            stats = self._get(lock_type)
+            stats['hold_time'] += hold_time
+            stats['max_hold_time'] = max(stats['max_hold_time'], hold_time)
+        self._log_periodically()
+
+    def _log_periodically(self):
+        if self.log_interval is None:
+            return
+        current_time = time.time()
+        with self._lock:
+            if current_time < self._next_log:
+                return
+            self._next_log = current_time + self.log_interval
+        self.log()
+
+    def log(self):
+        """Log the statistics of every lock type at level INFO."""
+        pid = os.getpid()
+        for lock_type, stats in sorted(self.snapshot().iteritems()):
+            logger.info('Lock %d in process %d: %d acquired, %d timeouts, '
+                        'waited %.3fs (max %.3fs), held %.3fs (max %.3fs)',
+                        lock_type, pid, stats['acquired'], stats['timeouts'],
+                        stats['wait_time'], stats['max_wait_time'],
+                        stats['hold_time'], stats['max_hold_time'])
+
+    def _get(self, lock_type):
+        return self._stats.setdefault(lock_type, {
+            'acquired': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'hold_time': 0.0,
+            'max_hold_time': 0.0
+        })
+
+    def snapshot(self):
+        """Return a dictionary mapping lock types to a copy of their stats.
+
+        The stats are the number of acquisitions and timeouts and the total
+        and maximum seconds spent waiting for and holding the lock.
+        """
+        with self._lock:
+            return dict((lock_type, dict(stats)) for lock_type, stats
+                        in self._stats.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+lock_stats = LockStats(getattr(settings, 'DBLOCK_STATS_INTERVAL', 300))
 
 class dblock(object):
-    def __init__(self, lock_type, obj_pk=0):
+    """Context manager for an advisory lock.
+
+    :param lock_type: Integer identifying the kind of lock.
+    :param obj_pk: Pk of the locked object, 0 locks the whole kind.
+    :param timeout: Seconds to wait for the lock before :class:`LockTimeout`
+                    is raised, None waits forever and 0 tries once.
+
+    The lock is held by the session, not by the transaction. To release it
+    after the changes are committed, put the transaction into the block.
+    """
+    # Seconds between two tries if a timeout is given
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, lock_type, obj_pk=0, timeout=None):
         self.lock_type = lock_type
         self.obj_pk = obj_pk
+        self.timeout = timeout
+        self._cursor = None
+        self._acquired_at = None
 
     def acquire(self):
         if connection.vendor != 'postgresql':
             # PostgreSQL is the preferred deployment setup, for
             # local testing with sqlite we need no locking
             return
-        c = connection.cursor()
-        c.execute('SELECT pg_advisory_lock({0:d}, {1:d});'.format(
-                self.lock_type, self.obj_pk))
-    
+        params = (self.lock_type, self.obj_pk)
+        self._cursor = connection.cursor()
+        start = time.time()
+        if self.timeout is None:
+            self._cursor.execute('SELECT pg_advisory_lock(%s, %s)', params)
+        else:
+            deadline = start + self.timeout
+            while True:
+                self._cursor.execute('SELECT pg_try_advisory_lock(%s, %s)',
+                                     params)
+                if self._cursor.fetchone()[0]:
+                    break
+                if time.time() >= deadline:
+                    self._timed_out(time.time() - start)
+                time.sleep(self.POLL_INTERVAL)
+        self._acquired_at = time.time()
+        wait_time = self._acquired_at - start
+        lock_stats.record_wait(self.lock_type, wait_time)
+        if wait_time > getattr(settings, 'DBLOCK_SLOW_WAIT', 1.0):
+            logger.warning('Waited %.3fs for lock %d/%d', wait_time,
+                           self.lock_type, self.obj_pk)
+
     def release(self):
         if connection.vendor != 'postgresql':
             return
-        c = connection.cursor()
-        c.execute('SELECT pg_advisory_unlock({0:d}, {1:d});'.format(
+        hold_time = time.time() - self._acquired_at
+        lock_stats.record_hold(self.lock_type, hold_time)
+        if hold_time > getattr(settings, 'DBLOCK_SLOW_HOLD', 1.0):
+            logger.warning('Held lock %d/%d for %.3fs', self.lock_type,
+                           self.obj_pk, hold_time)
+        # Nothing but a rollback can be executed in an aborted transaction,
+        # the lock would be held until the connection is closed
+        from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+        if (connection.connection.get_transaction_status() ==
+                TRANSACTION_STATUS_INERROR):
+            connection._rollback()
+        self._cursor.execute('SELECT pg_advisory_unlock(%s, %s)',
+                             (self.lock_type, self.obj_pk))
+        self._cursor = None
+
+    def _timed_out(self, wait_time):
+        lock_stats.record_wait(self.lock_type, wait_time, timed_out=True)
+        # Advisory locks with two keys store them in classid and objid
+        self._cursor.execute('SELECT pid FROM pg_locks WHERE '
+                             "locktype = 'advisory' AND granted AND "
+                             'classid = %s AND objid = %s AND objsubid = 2',
+                             (self.lock_type, self.obj_pk))
+        holders = [row[0] for row in self._cursor.fetchall()]
+        logger.warning('Timeout after %.3fs for lock %d/%d held by %s',
+                       wait_time, self.lock_type, self.obj_pk,
+                       holders or 'nobody')
+        self._cursor = None
+        raise LockTimeout('Lock {0}/{1} is held by another process'.format(
                 self.lock_type, self.obj_pk))
-    
+
     def __enter__(self):
         self.acquire()
-    
-    def __exit__(self, exc_type, exc_value, tb):
-        self.release()
-        return exc_type is None
+        return self
 
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.release()
+        else:
+            # Don't hide the error that left the block
+            try:
+                self.release()
+            except DatabaseError:
+                logger.exception('Could not release lock %d/%d',
+                                 self.lock_type, self.obj_pk)
+        return False
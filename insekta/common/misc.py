@@ -1,7 +1,12 @@
 from __future__ import division
+import os
 import sys
+import threading
+from collections import OrderedDict
 from functools import wraps
 
+from django.db import connection
+
 def consumer(fn):
     """Wrap a generator that received value and start it by calling next()."""
     @wraps(fn)
@@ -35,3 +40,97 @@ def progress_bar(maximum, length=74):
             sys.stdout.write('\033[u') # restore cursor
             sys.stdout.flush()
         last_num_hashes = num_hashes
+
+def parallel_map(fn, iterable):
+    """Call fn for every item in its own thread and return the results.
+
+    The results are in the same order as the items. If some calls raise an
+    exception, all other calls still run to completion and the first
+    exception is re-raised afterwards. Each thread closes its database
+    connection when it is done.
+    """
+    items = list(iterable)
+    if len(items) == 1:
+        return [fn(items[0])]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    def run(i, item):
+        try:
+            results[i] = fn(item)
+        except Exception:
+            errors[i] = sys.exc_info()
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(i, item))
+               for i, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+class LRUCache(object):
+    """A thread-safe dictionary holding at most `maxsize` items.
+
+    If it is full, the least recently used item is removed. The attributes
+    `hits` and `misses` count the lookups.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+def file_stamp(filename):
+    """Return a tuple that changes when a file is replaced or modified."""
+    stat = os.stat(filename)
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+def normalize_email(email):
+    """Lowercase the domain of an email address like
+    ``User.objects.create_user()`` does.
+    """
+    email = email.strip()
+    if '@' in email:
+        name, domain = email.split('@', 1)
+        email = u'@'.join([name, domain.lower()])
+    return email
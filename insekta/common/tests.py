@@ -4,9 +4,11 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import logging
 
 from django.test import TestCase
 
+from insekta.common.dblock import LockStats
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +16,51 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class LRUCacheTest(TestCase):
+    def test_evicts_least_recently_used(self):
+        from insekta.common.misc import LRUCache
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual((lru.hits, lru.misses), (3, 1))
+        self.assertEqual(lru.hit_rate, 0.75)
+
+class LockStatsTest(TestCase):
+    def test_records_waits_and_holds(self):
+        stats = LockStats()
+        stats.record_wait(1, 0.5)
+        stats.record_wait(1, 0.25)
+        stats.record_wait(1, 2.0, timed_out=True)
+        stats.record_hold(1, 0.1)
+        snapshot = stats.snapshot()[1]
+        self.assertEqual((snapshot['acquired'], snapshot['timeouts']), (2, 1))
+        self.assertEqual(snapshot['wait_time'], 2.75)
+        self.assertEqual(snapshot['max_wait_time'], 2.0)
+        self.assertEqual(snapshot['max_hold_time'], 0.1)
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+    def test_logs_periodically(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('insekta.dblock')
+        logger.addHandler(handler)
+        old_level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            stats = LockStats(log_interval=0)
+            stats.record_wait(1, 0.5)
+            LockStats().record_wait(1, 0.5)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+        self.assertEqual(len(records), 1)
+        self.assertTrue('1 acquired' in records[0].getMessage())
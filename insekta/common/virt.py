@@ -1,3 +1,5 @@
+import threading
+
 import libvirt
 
 from django.conf import settings
@@ -9,24 +11,30 @@ class ConnectionHandler(object):
     def __init__(self, libvirt_nodes):
         self.libvirt_nodes = libvirt_nodes
         self._connections = {}
+        self._lock = threading.Lock()
 
     def __getitem__(self, key):
-        if key not in self._connections:
-            try:
-                connection_url = self.libvirt_nodes[key]
-            except KeyError:
-                raise VirtError('No such node')
-            connection = libvirt.open(connection_url)
-            self._connections[key] = connection
-
-        return self._connections[key]
+        # Connections are shared between threads, make sure every node
+        # is only opened once
+        with self._lock:
+            if key not in self._connections:
+                try:
+                    connection_url = self.libvirt_nodes[key]
+                except KeyError:
+                    raise VirtError('No such node')
+                connection = libvirt.open(connection_url)
+                self._connections[key] = connection
+
+            return self._connections[key]
 
     def __iter__(self):
         return iter(self.libvirt_nodes)
 
     def close(self):
-        for key, conn in self._connections.items():
-            conn.close()
-            del self._connections[key]
+        with self._lock:
+            for key, conn in self._connections.items():
+                conn.close()
+                del self._connections[key]
 
 connections = ConnectionHandler(settings.LIBVIRT_NODES)
+lxc_connections = ConnectionHandler(getattr(settings, 'LIBVIRT_LXC_NODES', {}))
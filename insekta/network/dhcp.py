@@ -0,0 +1,113 @@
+"""Host map of the DHCP server.
+
+The host entries of all addresses are written to a file that the DHCP
+server reads in addition to its configuration, e.g. a ``dhcp-hostsfile``
+of dnsmasq. The file is only written if entries changed and it is replaced
+atomically, so the server never reads a half written file. dnsmasq reads
+the file again on SIGHUP, it does not need to be restarted.
+"""
+import os
+import signal
+import tempfile
+from itertools import islice
+
+from django.conf import settings
+
+from insekta.network.models import Address, NetworkError
+from insekta.network.utils import int_to_ip, ints_to_ips, cidr_to_netmask
+
+FORMATS = ('dnsmasq', 'isc')
+BATCH_SIZE = 1000
+
+def iterate_hosts(query_set=None):
+    """Yield tuples of pk, ip, mac and router ip of addresses, ordered
+    by ip. The IPs are converted in batches.
+
+    :param query_set: Query set of addresses, defaults to all.
+    """
+    if query_set is None:
+        query_set = Address.objects.all()
+    rows = query_set.order_by('ip_int').values_list('pk', 'ip_int',
+                                                    'mac').iterator()
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        pks, ip_ints, macs = zip(*batch)
+        ips = ints_to_ips(ip_ints)
+        router_ips = ints_to_ips([ip_int - 1 for ip_int in ip_ints])
+        for host in zip(pks, ips, macs, router_ips):
+            yield host
+
+def iterate_host_entries(format='dnsmasq'):
+    """Yield the host entry of every address as a line.
+
+    :param format: 'dnsmasq' for a ``dhcp-hostsfile`` or 'isc' for a file
+                   included by the ISC dhcp server.
+    """
+    if format == 'dnsmasq':
+        for pk, ip, mac, router_ip in iterate_hosts():
+            yield '{0},{1},vm{2}\n'.format(mac, ip, pk)
+    elif format == 'isc':
+        subnet_mask = int_to_ip(cidr_to_netmask(settings.VM_NET_SIZE))
+        for pk, ip, mac, router_ip in iterate_hosts():
+            yield ('host vm{0} {{ hardware ethernet {1}; fixed-address {2}; '
+                   'option subnet-mask {3}; option routers {4}; }}\n'.format(
+                   pk, mac, ip, subnet_mask, router_ip))
+    else:
+        raise NetworkError('Unknown DHCP host file format: {0}'.format(
+                format))
+
+def update_hosts_file(path=None, format=None, pid_file=None):
+    """Write the host map if it changed and make the DHCP server reload it.
+
+    The arguments default to the settings ``VM_DHCP_HOSTS_FILE``,
+    ``VM_DHCP_HOSTS_FORMAT`` and ``VM_DHCP_PID_FILE``. Only dnsmasq is
+    signaled, and only if there is a pid file. The ISC dhcp server does
+    not read its configuration on SIGHUP, it has to be restarted.
+
+    :return: Number of added and removed entries.
+    """
+    if path is None:
+        path = getattr(settings, 'VM_DHCP_HOSTS_FILE', None)
+        if path is None:
+            raise NetworkError('Please set VM_DHCP_HOSTS_FILE in settings.py')
+    if format is None:
+        format = getattr(settings, 'VM_DHCP_HOSTS_FORMAT', 'dnsmasq')
+    if pid_file is None:
+        pid_file = getattr(settings, 'VM_DHCP_PID_FILE', None)
+
+    entries = list(iterate_host_entries(format))
+    try:
+        with open(path) as f_hosts:
+            old_entries = set(f_hosts)
+    except IOError:
+        old_entries = set()
+    num_changed = len(old_entries.symmetric_difference(entries))
+    if not num_changed:
+        return 0
+
+    # Renaming within a directory is atomic
+    fd, tmp_path = tempfile.mkstemp(prefix='.dhcp-hosts',
+            dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f_tmp:
+            f_tmp.writelines(entries)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    if format == 'dnsmasq' and pid_file:
+        reload_server(pid_file)
+    return num_changed
+
+def reload_server(pid_file):
+    """Send SIGHUP to the DHCP server whose pid is in pid_file."""
+    try:
+        with open(pid_file) as f_pid:
+            pid = int(f_pid.read().strip())
+        os.kill(pid, signal.SIGHUP)
+    except (IOError, OSError, ValueError), e:
+        raise NetworkError('Could not signal the DHCP server: {0}'.format(e))
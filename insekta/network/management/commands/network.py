@@ -3,38 +3,75 @@ from __future__ import print_function
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-from insekta.network.models import Address
-from insekta.network.utils import ip_to_int, int_to_ip, cidr_to_netmask
+from insekta.network.models import Address, NetworkError
+from insekta.network.utils import int_to_ip, cidr_to_netmask, count_nets
+from insekta.network.dhcp import update_hosts_file, iterate_hosts
+from insekta.common.misc import progress_bar
 
 class Command(BaseCommand):
-    args = '<fill [amount=100] | dump | dhcpconf>'
-    help = ('Dumps network database or fill it with random mac addresses '
-            'or generate DHCP config host entries for ISC DHCP server ')
+    args = ('<fill [ip_block] | dump [ip_block] | dhcpconf | '
+            'dhcphosts [file] | stats>')
+    help = ('Dumps network database or fill it with the addresses of an '
+            'ip block (default VM_IP_BLOCK) '
+            'or generate DHCP config host entries for ISC DHCP server '
+            'or update the host file of the DHCP server '
+            'or show the utilisation of the address pool')
            
 
     def handle(self, *args, **options):
         if not args:
-            raise CommandError('What do you want? fill or dump or dhcpconf?')
+            raise CommandError('What do you want? fill or dump or dhcpconf '
+                               'or dhcphosts or stats?')
         
         if args[0] == 'fill':
-            addresses = Address.objects.fill_pool()
-            for addr in addresses:
-                print('{0}={1}'.format(addr.mac, addr.ip))
-            print('\nInserted {0} addresses.'.format(len(addresses)))
+            block = args[1] if len(args) > 1 else settings.VM_IP_BLOCK
+            progress = progress_bar(count_nets(block, settings.VM_NET_SIZE))
+            num_inserted = 0
+            try:
+                for num_nets, num_inserted in Address.objects.fill_pool(
+                        block):
+                    progress.send(num_nets)
+            except NetworkError, e:
+                raise CommandError(unicode(e))
+            finally:
+                progress.send(None)
+            print('\nInserted {0} addresses.'.format(num_inserted))
+            if num_inserted and getattr(settings, 'VM_DHCP_HOSTS_FILE', None):
+                self._update_hosts_file()
         elif args[0] == 'dump':
-            for addr in Address.objects.all():
-                print('{0}\t{1}'.format(addr.mac, addr.ip))
+            if len(args) > 1:
+                addresses = Address.objects.in_block(args[1])
+            else:
+                addresses = Address.objects.all()
+            for pk, ip, mac, router_ip in iterate_hosts(addresses):
+                print('{0}\t{1}'.format(mac, ip))
         elif args[0] == 'dhcpconf':
             subnet_ip, cidr = settings.VM_IP_BLOCK.split('/')
             netmask = int_to_ip(cidr_to_netmask(int(cidr)))
             print('subnet {0} netmask {1} {{'.format(subnet_ip, netmask))
-            for addr in Address.objects.all():
-                print('\thost vm{0} {{'.format(addr.pk))
-                print('\t\thardware ethernet {0};'.format(addr.mac))
-                print('\t\tfixed-address {0};'.format(addr.ip))
-                subnet_mask = int_to_ip(cidr_to_netmask(settings.VM_NET_SIZE))
+            subnet_mask = int_to_ip(cidr_to_netmask(settings.VM_NET_SIZE))
+            for pk, ip, mac, router_ip in iterate_hosts():
+                print('\thost vm{0} {{'.format(pk))
+                print('\t\thardware ethernet {0};'.format(mac))
+                print('\t\tfixed-address {0};'.format(ip))
                 print('\t\toption subnet-mask {0};'.format(subnet_mask))
-                router_ip = int_to_ip(ip_to_int(addr.ip) - 1)
                 print('\t\toption routers {0};'.format(router_ip))
                 print('\t}')
             print('}')
+        elif args[0] == 'dhcphosts':
+            self._update_hosts_file(args[1] if len(args) > 1 else None)
+        elif args[0] == 'stats':
+            stats = Address.objects.get_stats()
+            total = max(stats['total'], 1)
+            for key, label in (('total', 'Total'), ('in_use', 'In use'),
+                               ('cooling_down', 'Cooling down'),
+                               ('free', 'Free')):
+                print('{0:<14}{1:>8} {2:>6.1f}%'.format(label + ':',
+                        stats[key], 100.0 * stats[key] / total))
+
+    def _update_hosts_file(self, path=None):
+        try:
+            num_changed = update_hosts_file(path)
+        except NetworkError, e:
+            raise CommandError(unicode(e))
+        print('Changed {0} DHCP host entries.'.format(num_changed))
@@ -1,12 +1,12 @@
-import random
+from datetime import datetime, timedelta
+from itertools import islice
 
-from django.db import models, transaction, IntegrityError
+from django.db import models, transaction, connection
 from django.conf import settings
 
-from insekta.common.dblock import dblock
-from insekta.network.utils import iterate_nets, int_to_ip
-
-LOCK_NETWORK_ADDRESS = 947295
+from insekta.common.bulk import insert_many
+from insekta.network.utils import (iterate_nets, ip_to_int, ints_to_ips,
+                                   ip_to_mac, block_to_range)
 
 class NetworkError(Exception):
     pass
@@ -15,55 +15,210 @@ class AddressManager(models.Manager):
     def get_free(self):
         """Get a free address and mark it as in use."""
         try:
-            with dblock(LOCK_NETWORK_ADDRESS):
-                address = self.get_query_set().filter(in_use=False)[0]
-                address.take_address()
-                return address
-        except IndexError:
+            return self.get_free_many(1)[0]
+        except NetworkError:
             raise NetworkError('No more free addresses.')
 
-    @transaction.commit_manually
-    def fill_pool(self):
-        """Insert all addresses into the pool."""
-        def random_16():
-            return ''.join(random.choice('0123456789abcdef') for _i in (0, 1))
+    def get_free_many(self, count):
+        """Get a list of `count` free addresses and mark them as in use.
+
+        On PostgreSQL the addresses are claimed by a single UPDATE that
+        skips addresses locked by concurrent transactions, so concurrent
+        starts neither wait for each other nor get the same address.
+        Run it inside the transaction that uses the addresses, they are
+        free again if it is rolled back.
+
+        Released addresses are only taken again after their cooldown,
+        see :meth:`release`.
+        """
+        cooled_down = datetime.now() - get_cooldown()
+        if connection.vendor == 'postgresql':
+            address_pks = self._claim_skip_locked(count, cooled_down)
+        else:
+            address_pks = self._claim_each(count, cooled_down)
+
+        if len(address_pks) < count:
+            if address_pks:
+                self.get_query_set().filter(pk__in=address_pks).update(
+                        in_use=False)
+            raise NetworkError('Not enough free addresses.')
+
+        addresses = self.get_query_set().in_bulk(address_pks)
+        return [addresses[pk] for pk in address_pks]
+
+    def _claim_skip_locked(self, count, cooled_down):
+        """Mark up to `count` free addresses as in use, return their pks.
+
+        The partial index in ``sql/address.postgresql_psycopg2.sql`` keeps
+        finding free addresses fast when the pool is almost used up.
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute('UPDATE {0} SET in_use = true WHERE id IN ('
+                       'SELECT id FROM {0} WHERE NOT in_use AND '
+                       '(released_at IS NULL OR released_at <= %s) '
+                       'ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) '
+                       'RETURNING id'.format(table), [cooled_down, count])
+        address_pks = [row[0] for row in cursor.fetchall()]
+        transaction.commit_unless_managed()
+        return address_pks
+
+    def _claim_each(self, count, cooled_down):
+        """Mark up to `count` free addresses as in use, return their pks.
+
+        Other databases are only used for local testing, so each address
+        is claimed by its own UPDATE that only matches while it is free.
+        An address taken concurrently is replaced by another one.
+        """
+        query_set = self.get_query_set()
+        address_pks = []
+        while len(address_pks) < count:
+            free_pks = list(self._free(cooled_down).values_list('pk',
+                    flat=True)[:count - len(address_pks)])
+            if not free_pks:
+                break
+            for pk in free_pks:
+                if query_set.filter(pk=pk, in_use=False).update(in_use=True):
+                    address_pks.append(pk)
+        return address_pks
+
+    def _free(self, cooled_down):
+        return self.get_query_set().filter(models.Q(released_at__isnull=True) |
+                models.Q(released_at__lte=cooled_down), in_use=False)
+
+    def release(self, address_pks):
+        """Mark addresses as no longer in use.
+
+        They are parked for ``settings.VM_ADDRESS_COOLDOWN`` before they are
+        taken again, so ARP caches and DHCP leases of the old virtual
+        machine can expire.
+        """
+        return self.get_query_set().filter(pk__in=address_pks).update(
+                in_use=False, released_at=datetime.now())
+
+    def get_stats(self):
+        """Return a dictionary with the number of addresses in the pool.
 
-        new_addresses = []
+        The keys are ``total``, ``in_use``, ``cooling_down`` (released, but
+        not yet free again) and ``free``.
+        """
+        query_set = self.get_query_set()
+        total = query_set.count()
+        in_use = query_set.filter(in_use=True).count()
+        free = self._free(datetime.now() - get_cooldown()).count()
+        return {
+            'total': total,
+            'in_use': in_use,
+            'cooling_down': total - in_use - free,
+            'free': free
+        }
+
+    def fill_pool(self, block=None, batch_size=None):
+        """Insert the addresses of all nets of an IP block into the pool.
+
+        This is a generator yielding the number of processed nets and the
+        number of inserted addresses after each batch, which is committed
+        on its own. Addresses already in the pool are skipped, so the pool
+        can be grown by another block or a fill can be continued.
+
+        The MAC address of an IP address is its lower 24 bits appended to
+        ``settings.VM_MAC_OUI``, so they never collide within a /8.
+
+        :param block: IP block like '10.0.0.0/16', defaults to
+                      ``settings.VM_IP_BLOCK``.
+        :param batch_size: Number of addresses inserted by one statement.
+        """
         oui = getattr(settings, 'VM_MAC_OUI', '52:54:00')
         
-        if not hasattr(settings, 'VM_IP_BLOCK'):
-            raise NetworkError('Please set VM_IP_BLOCK in settings.py')
+        if block is None:
+            if not hasattr(settings, 'VM_IP_BLOCK'):
+                raise NetworkError('Please set VM_IP_BLOCK in settings.py')
+            block = settings.VM_IP_BLOCK
 
         if not hasattr(settings, 'VM_NET_SIZE'):
             raise NetworkError('Please set VM_NET_SIZE in settings.py')
+
+        if int(block.split('/')[1]) < 8:
+            raise NetworkError('Blocks larger than /8 have more addresses '
+                               'than MAC addresses in an OUI')
+
+        if batch_size is None:
+            # SQLite allows at most 999 parameters in a statement
+            batch_size = 5000 if connection.vendor == 'postgresql' else 240
        
-        vm_nets = iterate_nets(settings.VM_IP_BLOCK, settings.VM_NET_SIZE)
-        for net_ip_int in vm_nets:
-            mac = ':'.join((oui, random_16(), random_16(), random_16()))
-            ip = int_to_ip(net_ip_int + 2)
-            try:
-                new_addresses.append(Address.objects.create(mac=mac, ip=ip))
-            except IntegrityError:
-                transaction.rollback()
-            else:
-                transaction.commit()
-        return new_addresses
+        nets = iterate_nets(block, settings.VM_NET_SIZE)
+        num_nets = 0
+        num_inserted = 0
+        while True:
+            ip_ints = [net_ip_int + 2 for net_ip_int
+                       in islice(nets, batch_size)]
+            if not ip_ints:
+                break
+            num_inserted += self._insert_new(ip_ints, oui)
+            num_nets += len(ip_ints)
+            yield num_nets, num_inserted
+
+    def _insert_new(self, ip_ints, oui):
+        """Insert the ascending IPs that are not in the pool yet."""
+        query_set = self.get_query_set()
+        existing = set(query_set.filter(ip_int__gte=ip_ints[0],
+                ip_int__lte=ip_ints[-1]).values_list('ip_int', flat=True))
+        ip_ints = [ip_int for ip_int in ip_ints if ip_int not in existing]
+        if not ip_ints:
+            return 0
+
+        macs = [ip_to_mac(ip_int, oui) for ip_int in ip_ints]
+        conflict = query_set.filter(mac__in=macs)
+        if conflict.exists():
+            raise NetworkError('MAC address {0} is already used by another '
+                               'IP address'.format(conflict[0].mac))
+
+        rows = [(ip, ip_int, mac, False) for ip, ip_int, mac
+                in zip(ints_to_ips(ip_ints), ip_ints, macs)]
+        try:
+            insert_many(self.model, ('ip', 'ip_int', 'mac', 'in_use'), rows,
+                        batch_size=len(rows))
+        except:
+            transaction.rollback_unless_managed()
+            raise
+        transaction.commit_unless_managed()
+        return len(ip_ints)
+
+    def in_block(self, block):
+        """Return a query set of the addresses in an IP block, e.g.
+        '10.0.0.0/24'. It is a range query on the index of ``ip_int``.
+        """
+        min_ip, max_ip = block_to_range(block)
+        return self.get_query_set().filter(ip_int__gte=min_ip,
+                                           ip_int__lt=max_ip)
 
 
 class Address(models.Model):
     ip = models.IPAddressField(unique=True)
+    # The IP as integer for range queries
+    ip_int = models.BigIntegerField(unique=True)
     mac = models.CharField(max_length=17, unique=True)
     in_use = models.BooleanField(default=False)
+    released_at = models.DateTimeField(null=True, blank=True)
 
     objects = AddressManager()
 
     def __unicode__(self):
         return '{0} with IP {1}'.format(self.mac, self.ip)
 
+    def save(self, *args, **kwargs):
+        self.ip_int = ip_to_int(self.ip)
+        super(Address, self).save(*args, **kwargs)
+
     def take_address(self):
         self.in_use = True
         self.save()
 
     def return_address(self):
         self.in_use = False
+        self.released_at = datetime.now()
         self.save()
+
+def get_cooldown():
+    """Return the time a released address is not taken again."""
+    return getattr(settings, 'VM_ADDRESS_COOLDOWN', timedelta(minutes=15))
@@ -0,0 +1,2 @@
+-- Free addresses are claimed with FOR UPDATE SKIP LOCKED (PostgreSQL 9.5+)
+CREATE INDEX network_address_free ON network_address (id) WHERE NOT in_use;
@@ -5,7 +5,16 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
 from django.test import TestCase
+from django.conf import settings
+
+from insekta.network.models import Address, NetworkError
+from insekta.network.dhcp import update_hosts_file
 
 
 class SimpleTest(TestCase):
@@ -14,3 +23,61 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class AddressPoolTest(TestCase):
+    def setUp(self):
+        for i in xrange(3):
+            Address.objects.create(ip='10.0.0.{0}'.format(i),
+                                   mac='52:54:00:00:00:0{0}'.format(i))
+
+    def test_released_addresses_cool_down(self):
+        addresses = Address.objects.get_free_many(2)
+        self.assertEqual(Address.objects.get_stats()['free'], 1)
+
+        Address.objects.release([address.pk for address in addresses])
+        stats = Address.objects.get_stats()
+        self.assertEqual((stats['in_use'], stats['cooling_down']), (0, 2))
+        self.assertRaises(NetworkError, Address.objects.get_free_many, 2)
+
+        Address.objects.update(released_at=datetime.now() - timedelta(days=1))
+        self.assertEqual(len(Address.objects.get_free_many(3)), 3)
+
+class FillPoolTest(TestCase):
+    def setUp(self):
+        self._net_size = getattr(settings, 'VM_NET_SIZE', None)
+        settings.VM_NET_SIZE = 28
+
+    def tearDown(self):
+        settings.VM_NET_SIZE = self._net_size
+
+    def test_grow_pool(self):
+        progress = list(Address.objects.fill_pool('10.0.0.0/24', 10))
+        self.assertEqual(progress[-1], (16, 16))
+        self.assertEqual(Address.objects.get(ip='10.0.0.18').mac,
+                         '52:54:00:00:00:12')
+
+        progress = list(Address.objects.fill_pool('10.0.0.0/23', 10))
+        self.assertEqual(progress[-1], (32, 16))
+        self.assertEqual(Address.objects.count(), 32)
+
+    def test_hosts_file(self):
+        list(Address.objects.fill_pool('10.0.0.0/26'))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'hosts')
+            self.assertEqual(update_hosts_file(path, 'dnsmasq', ''), 4)
+            self.assertEqual(update_hosts_file(path, 'dnsmasq', ''), 0)
+
+            list(Address.objects.fill_pool('10.0.0.64/27'))
+            self.assertEqual(update_hosts_file(path, 'dnsmasq', ''), 2)
+            with open(path) as f_hosts:
+                self.assertEqual(len(f_hosts.readlines()), 6)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_in_block(self):
+        list(Address.objects.fill_pool('10.0.0.0/24'))
+        addresses = Address.objects.in_block('10.0.0.64/26')
+        self.assertEqual(sorted(addresses.values_list('ip', flat=True)),
+                         ['10.0.0.114', '10.0.0.66', '10.0.0.82',
+                          '10.0.0.98'])
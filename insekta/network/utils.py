@@ -1,37 +1,47 @@
+import socket
+import struct
+
 def ip_to_int(ip):
     """Pack an IP into an integer, e.g. '127.0.0.1' into 2130706433"""
-    ip_int = 0
-    for octet in ip.split('.'):
-        ip_int = (ip_int << 8) | int(octet, 10)
-    return ip_int
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
 
 def int_to_ip(ip_int):
     """Convert an integer into an IP, e.g. 2130706433 to '127.0.0.1'"""
-    octets = [0] * 4
-    for i in xrange(4):
-        octets[3 - i] = str(ip_int & 0xff)
-        ip_int >>= 8
-    return '.'.join(octets)
+    return socket.inet_ntoa(struct.pack('!I', ip_int))
+
+def ints_to_ips(ip_ints):
+    """Convert a list of integers into a list of IPs at once."""
+    packed = struct.pack('!{0}I'.format(len(ip_ints)), *ip_ints)
+    return [socket.inet_ntoa(packed[i:i + 4])
+            for i in xrange(0, len(packed), 4)]
 
 def cidr_to_netmask(cidr):
     """Convert a cidr to a netmask, e.g. /28 (as int) to 255.255.255.240."""
     return 0xffffffff ^ (1 << 32 - cidr) - 1
 
-def iterate_ips(block):
-    """Iterate over all IPs in an IP block."""
+def block_to_range(block):
+    """Return the first IP and the IP after the last one of an IP block as
+    integers, e.g. '10.0.0.0/24' to (167772160, 167772416)"""
     ip, cidr = block.split('/')
-    num_ips = 1 << (32 - int(cidr, 10))
     min_ip = ip_to_int(ip)
-    for i in xrange(num_ips):
-        yield min_ip + i
+    return min_ip, min_ip + (1 << (32 - int(cidr, 10)))
+
+def iterate_ips(block):
+    """Iterate over all IPs in an IP block."""
+    return iter(xrange(*block_to_range(block)))
 
 def iterate_nets(block, net_size):
     """Iterate over all nets in an IP blocks."""
-    next_net_offset = 1 << (32 - net_size)
+    min_ip, max_ip = block_to_range(block)
+    return iter(xrange(min_ip, max_ip, 1 << (32 - net_size)))
+
+def count_nets(block, net_size):
+    """Return the number of nets in an IP block."""
     ip, cidr = block.split('/')
-    max_net_ip = ip_to_int(ip) + (1 << (32 - int(cidr, 10)))
-    net_ip_int = ip_to_int(ip)
-    while net_ip_int < max_net_ip:
-        yield net_ip_int
-        net_ip_int += next_net_offset
+    return 1 << max(net_size - int(cidr, 10), 0)
 
+def ip_to_mac(ip_int, oui):
+    """Build a MAC from an OUI and the lower 24 bits of an IP as integer,
+    e.g. 2130706433 and '52:54:00' to '52:54:00:00:00:01'"""
+    return '{0}:{1:02x}:{2:02x}:{3:02x}'.format(oui, (ip_int >> 16) & 0xff,
+            (ip_int >> 8) & 0xff, ip_int & 0xff)
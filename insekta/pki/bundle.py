@@ -0,0 +1,89 @@
+"""The VPN bundle of a user.
+
+The bundle is a zip file with the user's certificate, the certificate of
+the CA and the OpenVPN configuration. It only changes with one of them, so
+it is cached with an ETag calculated from their contents. The shared files
+are read once per process and read again when they change.
+"""
+import hashlib
+import threading
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from contextlib import closing
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from django.core.cache import cache
+from django.conf import settings
+
+from insekta.common.misc import file_stamp
+
+class SharedFile(object):
+    """Contents of the file named by a setting, cached per process."""
+    def __init__(self, setting):
+        self.setting = setting
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._content = None
+        self._digest = None
+
+    def get(self):
+        """Return a tuple of the file's content and its SHA1 digest."""
+        filename = getattr(settings, self.setting)
+        stamp = (filename, file_stamp(filename))
+        with self._lock:
+            if stamp != self._stamp:
+                with open(filename, 'rb') as f_shared:
+                    self._content = f_shared.read()
+                self._digest = hashlib.sha1(self._content).hexdigest()
+                self._stamp = stamp
+            return self._content, self._digest
+
+ca_cert_file = SharedFile('PKI_CA_CERTFILE')
+openvpn_config_file = SharedFile('PKI_OPENVPN_CONFIG')
+
+def get_etag(certificate):
+    """Return the ETag of the bundle of a certificate.
+
+    :param certificate: Instance of
+                        :class:`insekta.pki.models.Certificate`.
+    """
+    etag = hashlib.sha1(certificate.certificate.encode('utf-8'))
+    etag.update(ca_cert_file.get()[1])
+    etag.update(openvpn_config_file.get()[1])
+    return '"{0}"'.format(etag.hexdigest())
+
+def get_bundle(certificate):
+    """Return a tuple of the ETag and the zip file of a certificate.
+
+    The zip file is built once and cached until it changes.
+    """
+    etag = get_etag(certificate)
+    key = 'pki_bundle:' + etag.strip('"')
+    bundle = cache.get(key)
+    if bundle is None:
+        bundle = build_bundle(certificate)
+        cache.set(key, bundle, getattr(settings,
+                'PKI_BUNDLE_CACHE_TIMEOUT', 24 * 60 * 60))
+    return etag, bundle
+
+def build_bundle(certificate):
+    """Build the zip file of a certificate.
+
+    The files get a fixed date, so building it again gives the same bytes
+    for the same ETag.
+    """
+    files = (
+        ('certificate.pem', certificate.certificate.encode('utf-8')),
+        ('ca.crt', ca_cert_file.get()[0]),
+        ('client.conf', openvpn_config_file.get()[0])
+    )
+    zip_content = StringIO()
+    with closing(ZipFile(zip_content, 'w', ZIP_DEFLATED)) as zip_file:
+        for filename, content in files:
+            info = ZipInfo(filename, date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0644 << 16
+            info.compress_type = ZIP_DEFLATED
+            zip_file.writestr(info, content)
+    return zip_content.getvalue()
@@ -0,0 +1,93 @@
+from __future__ import print_function
+import os
+import multiprocessing
+from optparse import make_option
+
+from M2Crypto import X509
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User, Group
+from django.db import connection
+from django.conf import settings
+
+from insekta.pki.models import Certificate, generate_key_and_certificate
+from insekta.common.misc import progress_bar
+
+class Command(BaseCommand):
+    args = '<output_dir> [username ...]'
+    help = ('Generates keys and certificates for a list of users or a whole '
+            'group and writes them to a directory, e.g. before a workshop')
+    option_list = BaseCommand.option_list + (
+        make_option('--group', dest='group', default=None,
+                    help='Issue certificates for all active users of this '
+                         'group'),
+        make_option('--workers', dest='workers', type='int',
+                    default=getattr(settings, 'PKI_SIGNING_WORKERS',
+                                    multiprocessing.cpu_count()),
+                    help='Number of processes generating keys'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('The first arg is the output directory')
+        output_dir = args[0]
+        if not os.path.isdir(output_dir):
+            raise CommandError('No such directory: {0}'.format(output_dir))
+
+        users = list(User.objects.filter(username__in=args[1:]))
+        if len(users) != len(args[1:]):
+            found = set(user.username for user in users)
+            missing = [name for name in args[1:] if name not in found]
+            raise CommandError('No such users: {0}'.format(
+                    ', '.join(missing)))
+
+        if options['group']:
+            try:
+                group = Group.objects.get(name=options['group'])
+            except Group.DoesNotExist:
+                raise CommandError('No such group: {0}'.format(
+                        options['group']))
+            users.extend(group.user_set.filter(is_active=True))
+
+        if not users:
+            raise CommandError('No users given')
+
+        certificates = [cert for cert in Certificate.objects.select_related(
+                'user').filter(user__in=users) if not cert.is_valid()]
+        print('Issuing {0} certificates, {1} users already have one.'.format(
+                len(certificates), len(set(users)) - len(certificates)))
+        if not certificates:
+            return
+
+        # The workers must not share the database connection
+        connection.close()
+        pool = multiprocessing.Pool(max(options['workers'], 1))
+        jobs = [(cert.pk, cert.user.username) for cert in certificates]
+        by_pk = dict((cert.pk, cert) for cert in certificates)
+        progress = progress_bar(len(jobs))
+        try:
+            for i, (pk, key_pem, cert_pem) in enumerate(pool.imap_unordered(
+                    _issue, jobs)):
+                cert = by_pk[pk]
+                self._write(output_dir, cert.user.username, key_pem,
+                            cert_pem)
+                cert.set_certificate(X509.load_cert_string(cert_pem))
+                progress.send(i + 1)
+        finally:
+            pool.terminate()
+            progress.send(None)
+        print('\nDone! Wrote keys and certificates to {0}.'.format(
+                output_dir))
+
+    def _write(self, output_dir, username, key_pem, cert_pem):
+        path = os.path.join(output_dir, username)
+        fd = os.open(path + '.key', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0600)
+        with os.fdopen(fd, 'w') as f_key:
+            f_key.write(key_pem)
+        with open(path + '.crt', 'w') as f_cert:
+            f_cert.write(cert_pem)
+
+def _issue(job):
+    pk, username = job
+    key_pem, cert_pem = generate_key_and_certificate(pk, username)
+    return pk, key_pem, cert_pem
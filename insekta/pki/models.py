@@ -1,12 +1,17 @@
 import time
+import threading
 from datetime import datetime
 
-from M2Crypto import EVP, X509, ASN1
+from M2Crypto import EVP, X509, ASN1, RSA
+from M2Crypto import threading as m2_threading
 from django.db import models
 from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 from django.conf import settings
 
+from insekta.common.misc import file_stamp
+from insekta.pki.bundle import get_bundle
+
 class Certificate(models.Model):
     user = models.OneToOneField(User)
     certificate = models.TextField(null=True, blank=True, default=None)
@@ -20,15 +25,51 @@ class Certificate(models.Model):
                  :class:`M2Crypto.X509.X509`.
         """
         cert = generate_certificate(csr, self.pk, self.user.username)
-        expires = cert.get_not_after().get_datetime()
+        self.set_certificate(cert)
+        return cert
+
+    def set_certificate(self, cert):
+        """Store a signed certificate in database.
+
+        :param cert: Instance of :class:`M2Crypto.X509.X509`.
+        """
         self.certificate = cert.as_pem()
-        self.expires = expires
+        self.expires = cert.get_not_after().get_datetime()
         self.save()
-        return cert
+        # Build the bundle now, users download it right after
+        get_bundle(self)
 
     def is_valid(self):
         return self.certificate and self.expires > datetime.utcnow()
 
+class CertificateAuthority(object):
+    """Key and certificate of the CA, loaded once per process.
+
+    The files are checked on every access and loaded again if they were
+    replaced or modified.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._key = None
+        self._cert = None
+
+    def get(self):
+        """Return a tuple of the CA's key and certificate."""
+        stamp = (file_stamp(settings.PKI_CA_KEYFILE),
+                 file_stamp(settings.PKI_CA_CERTFILE))
+        with self._lock:
+            if stamp != self._stamp:
+                self._key = EVP.load_key(settings.PKI_CA_KEYFILE,
+                                         lambda *args: None)
+                self._cert = X509.load_cert(settings.PKI_CA_CERTFILE)
+                self._stamp = stamp
+            return self._key, self._cert
+
+# The key is shared by the threads of a process
+m2_threading.init()
+certificate_authority = CertificateAuthority()
+
 def generate_certificate(csr, serial, cn):
     """Generate a certificate and sign it with CA.
 
@@ -37,8 +78,7 @@ def generate_certificate(csr, serial, cn):
     :param cn: Common Name of the certificate.
     :return: Generated + signed certificate. See :class:`M2Crypto.X509.X509`.
     """
-    ca_key = EVP.load_key(settings.PKI_CA_KEYFILE, lambda *args: None)
-    ca_cert = X509.load_cert(settings.PKI_CA_CERTFILE)
+    ca_key, ca_cert = certificate_authority.get()
     
     cert = X509.X509()
     cert.set_serial_number(serial)
@@ -63,6 +103,24 @@ def generate_certificate(csr, serial, cn):
     cert.sign(ca_key, 'sha1')
     return cert
 
+def generate_key_and_certificate(serial, cn, bits=2048):
+    """Generate a key pair and a certificate for it signed by the CA.
+
+    This is used to issue certificates without a CSR of the user.
+
+    :param serial: Serial number of the certificate as long int.
+    :param cn: Common Name of the certificate.
+    :return: Tuple of the private key and the certificate, both as PEM.
+    """
+    rsa = RSA.gen_key(bits, 65537, lambda *args: None)
+    key = EVP.PKey()
+    key.assign_rsa(rsa, capture=False)
+    csr = X509.Request()
+    csr.set_pubkey(key)
+    csr.sign(key, 'sha1')
+    cert = generate_certificate(csr, serial, cn)
+    return rsa.as_pem(cipher=None), cert.as_pem()
+
 def _create_user_cb(sender, instance, created, **kwargs):
     """Create an certificate object for each new user. """
     if created:
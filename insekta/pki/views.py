@@ -1,10 +1,3 @@
-from zipfile import ZipFile
-from contextlib import closing
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
 from M2Crypto import X509
 from django.shortcuts import redirect
 from django.core.urlresolvers import reverse
@@ -12,8 +5,13 @@ from django.template.response import TemplateResponse
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django import forms
-from django.http import HttpResponse
-from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from django.utils.cache import patch_cache_control
+
+from insekta.pki.bundle import get_etag, get_bundle
+
+CHUNK_SIZE = 8192
 
 @login_required
 def home(request):
@@ -47,11 +45,20 @@ def home(request):
 @login_required
 @user_passes_test(lambda u: u.certificate.is_valid())
 def download_cert(request):
-    zip_content = StringIO()
-    with closing(ZipFile(zip_content, 'w')) as zip_file:
-        cert_content = request.user.certificate.certificate.encode('utf-8')
-        zip_file.writestr('certificate.pem', cert_content)
-        zip_file.write(settings.PKI_CA_CERTFILE, 'ca.crt')
-        zip_file.write(settings.PKI_OPENVPN_CONFIG, 'client.conf')
-    return HttpResponse(zip_content.getvalue(),
-                        mimetype='application/x-zip-compressed')
+    certificate = request.user.certificate
+    etag = get_etag(certificate)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and etag.strip('"') in parse_etags(if_none_match):
+        response = HttpResponseNotModified()
+    else:
+        etag, bundle = get_bundle(certificate)
+        response = HttpResponse(_iterate_chunks(bundle),
+                                mimetype='application/x-zip-compressed')
+        response['Content-Length'] = str(len(bundle))
+    response['ETag'] = etag
+    patch_cache_control(response, private=True)
+    return response
+
+def _iterate_chunks(data):
+    for offset in xrange(0, len(data), CHUNK_SIZE):
+        yield data[offset:offset + CHUNK_SIZE]
@@ -0,0 +1,152 @@
+from __future__ import print_function
+import csv
+import datetime
+import multiprocessing
+from optparse import make_option
+
+from django import forms
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ValidationError
+from django.contrib.auth.models import User, Group
+from django.contrib.auth.forms import UserCreationForm
+from django.db import connection, transaction
+
+from insekta.common.bulk import insert_many, filter_many
+from insekta.common.misc import normalize_email
+from insekta.pki.models import Certificate
+
+_USER_COLUMNS = ('username', 'first_name', 'last_name', 'email', 'password',
+                 'is_staff', 'is_active', 'is_superuser', 'last_login',
+                 'date_joined')
+
+class Command(BaseCommand):
+    args = '<csv_file>'
+    help = ('Creates users from a CSV file with the columns username, email '
+            'and optionally password, first_name and last_name, e.g. for '
+            'the participants of a course')
+    option_list = BaseCommand.option_list + (
+        make_option('--group', dest='group', default=None,
+                    help='Add the users to this group'),
+        make_option('--inactive', dest='inactive', action='store_true',
+                    default=False,
+                    help='Create the users as inactive'),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help='Number of processes hashing the passwords'),
+        make_option('--certificates', dest='certificates', default=None,
+                    help='Issue certificates and write them with their '
+                         'keys to this directory'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('The only arg is a CSV file')
+
+        group = None
+        if options['group']:
+            try:
+                group = Group.objects.get(name=options['group'])
+            except Group.DoesNotExist:
+                raise CommandError('No such group: {0}'.format(
+                        options['group']))
+
+        try:
+            with open(args[0], 'rb') as f_csv:
+                rows = self._read_rows(f_csv)
+        except (IOError, csv.Error), e:
+            raise CommandError('Could not read CSV file: {0}'.format(e))
+
+        existing = set(filter_many(User.objects.values_list('username',
+                flat=True), 'username', [row['username'] for row in rows]))
+        rows = [row for row in rows if row['username'] not in existing]
+        print('Importing {0} users, {1} already exist.'.format(len(rows),
+                len(existing)))
+        if not rows:
+            return
+
+        passwords = self._hash_passwords([row['password'] for row in rows],
+                                         options['workers'])
+        now = datetime.datetime.now()
+        users = []
+        for row, password in zip(rows, passwords):
+            users.append((row['username'], row['first_name'],
+                          row['last_name'], row['email'], password, False,
+                          not options['inactive'], False, now, now))
+
+        # The rows are inserted without post_save signals, so everything
+        # their receivers do is done here: pki creates the certificates
+        with transaction.commit_on_success():
+            insert_many(User, _USER_COLUMNS, users)
+            user_pks = filter_many(User.objects.values_list('pk', flat=True),
+                    'username', [row['username'] for row in rows])
+            insert_many(Certificate, ('user_id', ), [(pk, ) for pk
+                                                      in user_pks])
+            if group is not None:
+                insert_many(User.groups.through, ('user_id', 'group_id'),
+                            [(pk, group.pk) for pk in user_pks])
+        print('Created {0} users.'.format(len(user_pks)))
+
+        if options['certificates']:
+            call_command('issuecerts', options['certificates'],
+                         *[row['username'] for row in rows])
+
+    def _read_rows(self, f_csv):
+        reader = csv.DictReader(f_csv)
+        missing = set(['username', 'email']).difference(
+                reader.fieldnames or ())
+        if missing:
+            raise CommandError('Missing columns: {0}'.format(
+                    ', '.join(sorted(missing))))
+
+        # The rows are inserted directly, so they are checked like the
+        # registration form and the model do
+        fields = [
+            ('username', UserCreationForm.base_fields['username'].clean),
+            ('email', forms.EmailField(required=False).clean),
+            ('first_name', _model_field_clean('first_name')),
+            ('last_name', _model_field_clean('last_name'))
+        ]
+        rows = []
+        seen = set()
+        for row in reader:
+            row = dict((key, (value or '').decode('utf-8').strip())
+                       for key, value in row.iteritems() if key)
+            for key, clean in fields:
+                try:
+                    clean(row.get(key, u''))
+                except ValidationError, e:
+                    raise CommandError(u'Line {0}: {1}: {2}'.format(
+                            reader.line_num, key, u' '.join(e.messages)))
+            if row['username'] in seen:
+                raise CommandError('Line {0}: Duplicate username {1}'.format(
+                        reader.line_num, row['username']))
+            seen.add(row['username'])
+            for key in ('password', 'first_name', 'last_name'):
+                row.setdefault(key, u'')
+            row['email'] = normalize_email(row['email'])
+            rows.append(row)
+        return rows
+
+    def _hash_passwords(self, passwords, workers):
+        if workers <= 1:
+            return map(_hash_password, passwords)
+        # The workers must not share the database connection
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_hash_password, passwords, chunksize=100)
+        finally:
+            pool.terminate()
+
+def _model_field_clean(name):
+    field = User._meta.get_field(name)
+    return lambda value: field.clean(value, None)
+
+def _hash_password(password):
+    """Return the password hash, an unusable one for an empty password."""
+    user = User()
+    if password:
+        user.set_password(password)
+    else:
+        user.set_unusable_password()
+    return user.password
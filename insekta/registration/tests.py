@@ -4,6 +4,8 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import os
+import tempfile
 
 from django.test import TestCase
 
@@ -14,3 +16,37 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class ImportUsersTest(TestCase):
+    def test_import(self):
+        from django.core.management import call_command
+        from django.contrib.auth.models import User, Group
+        from insekta.pki.models import Certificate
+        group = Group.objects.create(name='course')
+        User.objects.create_user('old', 'old@example.com', 'old')
+        fd, csv_file = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f_csv:
+            f_csv.write('username,email,password,first_name\n'
+                        'old,new@example.com,new,\n'
+                        'alice,Alice@EXAMPLE.com,secret,Alice\n'
+                        'bob,bob@example.com,,\n')
+        try:
+            call_command('importusers', csv_file, group='course')
+        finally:
+            os.remove(csv_file)
+
+        old = User.objects.get(username='old')
+        self.assertEqual(old.email, 'old@example.com')
+        self.assertFalse(old.groups.exists())
+
+        alice = User.objects.get(username='alice')
+        self.assertEqual(alice.email, 'Alice@example.com')
+        self.assertEqual(alice.first_name, 'Alice')
+        self.assertTrue(alice.check_password('secret'))
+        self.assertFalse(User.objects.get(username='bob')
+                         .has_usable_password())
+
+        imported = User.objects.filter(username__in=['alice', 'bob'])
+        self.assertEqual(set(group.user_set.all()), set(imported))
+        self.assertEqual(Certificate.objects.filter(user__in=imported)
+                         .count(), 2)
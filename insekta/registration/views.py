@@ -10,6 +10,8 @@ from django.template.response import TemplateResponse
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
 
+from insekta.common.misc import normalize_email
+
 class RegisterForm(UserCreationForm):
     email = forms.EmailField()
 
@@ -20,9 +22,10 @@ def registration(request):
         if register_form.is_valid():
             data = register_form.cleaned_data
             verification_hash = _username_verification_hash(data['username'])
-            user = User.objects.create_user(data['username'], data['email'],
-                                            data['password1'])
-            user.is_active = False
+            # Saved once, as inactive user
+            user = User(username=data['username'],
+                        email=normalize_email(data['email']), is_active=False)
+            user.set_password(data['password1'])
             user.save()
             return redirect(reverse('registration.pending',
                 args=(data['username'], verification_hash)))
@@ -1,15 +1,88 @@
 from django.contrib import admin
+from django.contrib.auth.models import User, Group
+from django.template.response import TemplateResponse
+from django import forms
 
 from insekta.scenario.models import (Scenario, Secret, ScenarioRun,
                                      SubmittedSecret, ScenarioGroup,
-                                     ScenarioBelonging, UserProgress)
+                                     ScenarioBelonging, UserProgress,
+                                     ScenarioMachine, RunTaskQueue,
+                                     ScenarioError)
+from insekta.network.models import NetworkError
 
 class SecretInline(admin.TabularInline):
     model = Secret
 
+class ScenarioMachineInline(admin.TabularInline):
+    model = ScenarioMachine
+
+class ProvisionForm(forms.Form):
+    _selected_action = forms.CharField(widget=forms.MultipleHiddenInput)
+    group = forms.ModelChoiceField(Group.objects.all(), required=False)
+    usernames = forms.CharField(widget=forms.Textarea(attrs={'rows': 10}),
+                                required=False,
+                                help_text='One username per line')
+
+    def clean(self):
+        data = self.cleaned_data
+        usernames = [name.strip() for name in
+                     data.get('usernames', '').splitlines() if name.strip()]
+        users = list(User.objects.filter(username__in=usernames))
+        if len(users) != len(usernames):
+            found = set(user.username for user in users)
+            missing = [name for name in usernames if name not in found]
+            raise forms.ValidationError('No such users: {0}'.format(
+                    ', '.join(missing)))
+        if data.get('group'):
+            users.extend(data['group'].user_set.filter(is_active=True))
+        if not users:
+            raise forms.ValidationError('Select a group or enter usernames.')
+        data['users'] = users
+        return data
+
+def provision_runs(modeladmin, request, queryset):
+    """Start the selected scenarios for a group or a list of users.
+
+    The runs are allocated at once, creating the domains is left to the vmd.
+    """
+    if 'apply' in request.POST:
+        form = ProvisionForm(request.POST)
+        if form.is_valid():
+            for scenario in queryset:
+                try:
+                    runs = scenario.provision(form.cleaned_data['users'])
+                except (ScenarioError, NetworkError), e:
+                    modeladmin.message_user(request, u'{0}: {1}'.format(
+                            scenario.name, e))
+                    continue
+                for scenario_run in runs:
+                    RunTaskQueue.objects.create(scenario_run=scenario_run,
+                                                action='create')
+                modeladmin.message_user(request,
+                        u'{0}: {1} runs provisioned.'.format(scenario.name,
+                                                             len(runs)))
+            return None
+    else:
+        form = ProvisionForm(initial={'_selected_action':
+                request.POST.getlist(admin.ACTION_CHECKBOX_NAME)})
+
+    return TemplateResponse(request, 'admin/scenario/provision.html', {
+        'title': 'Provision scenario runs',
+        'scenarios': queryset,
+        'provision_form': form,
+        'action_checkbox_name': admin.ACTION_CHECKBOX_NAME
+    })
+provision_runs.short_description = 'Provision runs for users or a group'
+
 class ScenarioAdmin(admin.ModelAdmin):
-    list_display = ('name', 'title', 'memory', 'enabled')
-    inlines = [SecretInline]
+    list_display = ('name', 'title', 'enabled')
+    exclude = ('compiled_description', 'description_hash')
+    inlines = [ScenarioMachineInline, SecretInline]
+    actions = [provision_runs]
+
+    def save_model(self, request, obj, form, change):
+        obj.compile_description()
+        obj.save()
 
 
 def scenario_name(obj):
@@ -21,7 +94,7 @@ def scenario_title(obj):
 scenario_title.short_description = 'Scenario title'
 
 def vm_state(obj):
-    return obj.vm.state
+    return obj.state
 vm_state.short_description = 'VM state'
 
 class ScenarioRunAdmin(admin.ModelAdmin):
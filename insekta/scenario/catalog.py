@@ -0,0 +1,114 @@
+"""In-process cache of scenarios, their secrets and the scenario groups.
+
+Every process keeps a :class:`Catalog` with all scenarios and checks
+a version number in Django's cache on each access. Saving or deleting
+a scenario, secret, group or belonging increments the version, so all
+processes load the catalog again. As a saving transaction may not be
+committed when the version changes, a catalog is also reloaded after
+``SCENARIO_CATALOG_MAX_AGE`` seconds.
+"""
+import time
+import threading
+from operator import attrgetter
+
+from django.core.cache import cache
+from django.conf import settings
+from django.http import Http404
+
+from insekta.scenario.models import (Scenario, Secret, ScenarioGroup,
+                                     ScenarioBelonging,
+                                     calculate_secret_tokens)
+
+VERSION_KEY = 'scenario_catalog_version'
+TOKEN_CACHE_TIMEOUT = 24 * 60 * 60
+
+class Catalog(object):
+    """All scenarios and scenario groups, loaded with three queries.
+
+    The scenario objects are shared between requests, so views must not
+    modify them. Use :func:`copy.copy` before attaching attributes.
+    """
+    def __init__(self, version):
+        self.version = version
+        self.loaded_at = time.time()
+        self.scenarios = dict((scenario.name, scenario) for scenario
+                              in Scenario.objects.all())
+
+        secrets = {}
+        for scenario_id, secret in Secret.objects.values_list('scenario',
+                                                              'secret'):
+            secrets.setdefault(scenario_id, set()).add(secret)
+        self.secrets = dict((scenario_id, frozenset(scenario_secrets))
+                            for scenario_id, scenario_secrets
+                            in secrets.iteritems())
+
+        scenarios_by_pk = dict((scenario.pk, scenario) for scenario
+                               in self.scenarios.itervalues())
+        groups = dict((group.pk, (group, [])) for group
+                      in ScenarioGroup.objects.all())
+        for belonging in ScenarioBelonging.objects.order_by('rank'):
+            scenario = scenarios_by_pk[belonging.scenario_id]
+            if scenario.enabled:
+                groups[belonging.scenario_group_id][1].append(scenario)
+        self.groups = sorted(groups.itervalues(),
+                             key=lambda group: group[0].title)
+
+    def get_enabled_scenarios(self):
+        """Return a list of all enabled scenarios, sorted by title."""
+        return sorted((scenario for scenario in self.scenarios.itervalues()
+                       if scenario.enabled), key=attrgetter('title'))
+
+    def get_secrets(self, scenario):
+        """Return a frozenset of the secrets of a scenario."""
+        return self.secrets.get(scenario.pk, frozenset())
+
+    def get_secret_tokens(self, user, scenario):
+        """Return a dictionary mapping the secrets of a scenario to
+        their security tokens for a user.
+
+        The tokens are cached until the catalog changes.
+        """
+        key = 'secret_tokens:{0}:{1}:{2}'.format(self.version, user.pk,
+                                                 scenario.pk)
+        tokens = cache.get(key)
+        if tokens is None:
+            tokens = calculate_secret_tokens(user, self.get_secrets(scenario))
+            cache.set(key, tokens, TOKEN_CACHE_TIMEOUT)
+        return tokens
+
+_catalog = None
+_lock = threading.Lock()
+
+def get_catalog():
+    """Return the current catalog, loading it if it is outdated."""
+    global _catalog
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = _reset_version()
+    max_age = getattr(settings, 'SCENARIO_CATALOG_MAX_AGE', 60)
+    catalog = _catalog
+    if (catalog is None or catalog.version != version or
+            time.time() - catalog.loaded_at > max_age):
+        with _lock:
+            catalog = _catalog = Catalog(version)
+    return catalog
+
+def invalidate():
+    """Make all processes load the catalog again."""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        _reset_version()
+
+def _reset_version():
+    # The time is unlikely to match the version of a running process
+    version = int(time.time() * 1000)
+    cache.set(VERSION_KEY, version, 24 * 60 * 60)
+    return version
+
+def get_enabled_scenario(name):
+    """Return an enabled scenario by name or raise Http404."""
+    scenario = get_catalog().scenarios.get(name)
+    if scenario is None or not scenario.enabled:
+        raise Http404('No such scenario')
+    return scenario
@@ -11,14 +11,16 @@ import hashlib
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-from insekta.scenario.models import Scenario, Secret
-from insekta.scenario.markup.parsesecrets import extract_secrets
-from insekta.vm.models import BaseImage
+from insekta.scenario.models import Scenario, ScenarioMachine, Secret
+from insekta.scenario.markup.creole import code_cache
+from insekta.scenario import catalog
+from insekta.vm.models import BaseImage, BACKEND_CHOICES
 from insekta.common.virt import connections
 from insekta.common.misc import progress_bar
 
 CHUNK_SIZE = 8192
-_REQUIRED_KEYS = ['name', 'title', 'memory', 'image']
+_REQUIRED_KEYS = ['name', 'title']
+_REQUIRED_MACHINE_KEYS = ['name', 'memory', 'image']
 
 class Command(BaseCommand):
     args = '<scenario_path>'
@@ -45,6 +47,37 @@ class Command(BaseCommand):
             if required_key not in metadata:
                 raise CommandError('Metadata requires the key{0}'.format(
                         required_key))
+
+        # A scenario either lists its virtual machines in "vms" or
+        # consists of a single virtual machine described by "memory"
+        # and "image"
+        if 'vms' in metadata:
+            machines = metadata['vms']
+            if not isinstance(machines, list) or not machines:
+                raise CommandError('Metadata key vms must be a non-empty list')
+        else:
+            machines = [{
+                'name': 'main',
+                'memory': metadata.get('memory'),
+                'image': metadata.get('image')
+            }]
+
+        backends = dict(BACKEND_CHOICES)
+
+        machine_names = set()
+        for machine in machines:
+            for required_key in _REQUIRED_MACHINE_KEYS:
+                if not machine.get(required_key):
+                    raise CommandError('Virtual machine requires the key '
+                                       '{0}'.format(required_key))
+            if machine['name'] in machine_names:
+                raise CommandError('Duplicate virtual machine {0}'.format(
+                        machine['name']))
+            machine_names.add(machine['name'])
+            machine.setdefault('backend', metadata.get('backend', 'kvm'))
+            if machine['backend'] not in backends:
+                raise CommandError('Unknown backend {0}'.format(
+                        machine['backend']))
        
         # Reading description
         description_file = os.path.join(scenario_dir, 'description.creole')
@@ -54,8 +87,18 @@ class Command(BaseCommand):
         except IOError, e:
             raise CommandError('Could not read description: {0}'.format(e))
 
-        # Checking image
-        scenario_img = os.path.join(scenario_dir, metadata['image'])
+        # Checking images
+        for machine in machines:
+            machine['path'] = os.path.join(scenario_dir, machine['image'])
+            machine['size'] = self._get_image_size(machine['path'])
+
+        # Directory containing static media files for the scenario
+        media_dir = os.path.join(scenario_dir, 'media')
+
+        self._create_scenario(metadata, description, machines, media_dir,
+                              options)
+
+    def _get_image_size(self, scenario_img):
         if not os.path.exists(scenario_img):
             raise CommandError('Image file is missing')
         if not os.path.isfile(scenario_img):
@@ -70,49 +113,30 @@ class Command(BaseCommand):
         if not match:
             raise CommandError('Invalid image file format')
        
-        scenario_size = int(match.group(1))
-
-        # Directory containing static media files for the scenario
-        media_dir = os.path.join(scenario_dir, 'media')
-
-        self._create_scenario(metadata, description, scenario_img,
-                              scenario_size, media_dir, options)
-
-    def _create_scenario(self, metadata, description, scenario_img,
-                         scenario_size, media_dir, options):
-        secrets = extract_secrets(description)
-        num_secrets = len(secrets)
-        
-        image_name = 'si' + str(int(time.time() * 1000))
-        image_hash = self._calculate_image_hash(scenario_img)
+        return int(match.group(1))
 
+    def _create_scenario(self, metadata, description, machines, media_dir,
+                         options):
         try:
             scenario = Scenario.objects.get(name=metadata['name'])
             was_enabled = scenario.enabled
             scenario.title = metadata['title']
-            scenario.memory = metadata['memory']
             scenario.description = description
-            scenario.num_secrets = num_secrets 
             scenario.enabled = False
             created = False
-            image = scenario.image
-            if image_hash != image.hash:
-                image = BaseImage.objects.create(name=image_name,
-                                                 hash=image_hash)
-                upload_image = True
-            else:
-                upload_image = False
             print('Updating scenario ...')
         except Scenario.DoesNotExist:
-            image = BaseImage.objects.create(name=image_name, hash=image_hash)
             scenario = Scenario(name=metadata['name'], title=
-                    metadata['title'], memory=metadata['memory'],
-                    image=image, description=description,
-                    num_secrets=num_secrets)
+                    metadata['title'], description=description)
             created = True
-            upload_image = True
             print('Creating scenario ...')
-        
+
+        print('Compiling description ...')
+        misses = code_cache.misses
+        secrets = frozenset(scenario.compile_description()['secrets'])
+        print('Highlighted {0} code blocks.'.format(code_cache.misses -
+                                                    misses))
+        scenario.num_secrets = len(secrets)
         scenario.save()
 
         print('Importing secrets for scenario ...')
@@ -132,17 +156,45 @@ class Command(BaseCommand):
         if os.path.exists(media_dir):
             shutil.copytree(media_dir, media_target)
 
-        if upload_image:
-            print('Storing image on all nodes:')
-            for node in scenario.get_nodes():
-                volume = self._create_volume(node, image, scenario_size)
-                self._upload_image(node, scenario_img, scenario_size, volume)
-                connections.close()
+        print('Importing virtual machines ...')
+        old_machines = dict((machine.name, machine) for machine in
+                            ScenarioMachine.objects.filter(scenario=scenario))
+        for i, machine in enumerate(machines):
+            image_hash = self._calculate_image_hash(machine['path'])
+            scenario_machine = old_machines.pop(machine['name'], None)
+            if (scenario_machine is not None and
+                    scenario_machine.image.hash == image_hash):
+                image = scenario_machine.image
+            else:
+                image_name = 'si{0}-{1}'.format(int(time.time() * 1000), i)
+                image = BaseImage.objects.create(name=image_name,
+                                                 hash=image_hash)
+                print('Storing image of {0} on all nodes:'.format(
+                        machine['name']))
+                for node in scenario.get_nodes():
+                    volume = self._create_volume(node, image, machine['size'])
+                    self._upload_image(node, machine['path'],
+                                       machine['size'], volume)
+                    connections.close()
+
+            if scenario_machine is None:
+                scenario_machine = ScenarioMachine(scenario=scenario,
+                                                   name=machine['name'])
+            scenario_machine.memory = machine['memory']
+            scenario_machine.backend = machine['backend']
+            scenario_machine.image = image
+            scenario_machine.save()
+
+        for scenario_machine in old_machines.itervalues():
+            scenario_machine.delete()
 
         if not created:
-            scenario.image = image
             scenario.enabled = was_enabled
             scenario.save()
+
+        # Saving already invalidates the catalog, but the web processes
+        # could have loaded it again before the last change
+        catalog.invalidate()
         
         enable_str = 'is' if scenario.enabled else 'is NOT'
         print('Done! Scenario {0} enabled'.format(enable_str))
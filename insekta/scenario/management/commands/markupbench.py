@@ -0,0 +1,79 @@
+from __future__ import print_function
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from insekta.scenario.markup.parsesecrets import (extract_secrets,
+                                                  _extract_secrets_creole)
+from insekta.scenario.markup.highlight import (highlight_parts,
+                                               _highlight_parts_reference)
+
+class Command(BaseCommand):
+    args = '<description_file>'
+    help = ('Compares the speed of the markup functions with their '
+            'reference implementations on a large description')
+    option_list = BaseCommand.option_list + (
+        make_option('--copies', dest='copies', type='int', default=50,
+                    help='Number of copies of the description to join'),
+        make_option('--repeat', dest='repeat', type='int', default=3,
+                    help='Number of runs, the fastest one is reported'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('The only arg is a description file')
+
+        try:
+            with open(args[0]) as f_description:
+                description = f_description.read().decode('utf-8')
+        except IOError, e:
+            raise CommandError('Could not read description: {0}'.format(e))
+
+        text = u'\n\n'.join([description] * options['copies'])
+        print('Description with {0} characters, {1} copies.'.format(
+                len(text), options['copies']))
+
+        self._compare('extract_secrets', _extract_secrets_creole,
+                      extract_secrets, text, options['repeat'])
+
+        hexdump = _annotated_hexdump(text.encode('utf-8'))
+        print('Annotated hexdump with {0} lines.'.format(
+                hexdump.count('\n') + 1))
+        self._compare('highlight_parts',
+                      lambda x: _highlight_parts_reference(x, _marking),
+                      lambda x: highlight_parts(x, _marking),
+                      hexdump, options['repeat'])
+
+    def _compare(self, name, reference, function, text, repeat):
+        ref_time, ref_result = _measure(reference, text, repeat)
+        new_time, new_result = _measure(function, text, repeat)
+        if ref_result != new_result:
+            raise CommandError('{0}: Results differ from reference'.format(
+                    name))
+        print('{0}: {1:.3f}s, reference {2:.3f}s ({3:.1f}x faster)'.format(
+                name, new_time, ref_time, ref_time / max(new_time, 1e-6)))
+
+def _marking(some_str, char):
+    return u'<<color {0}>>**{1}**<</color>>'.format(char, some_str)
+
+def _annotated_hexdump(data):
+    """Return a hexdump of data with a marker line below every line."""
+    lines = []
+    for offset in xrange(0, len(data), 16):
+        chunk = data[offset:offset + 16]
+        lines.append(u'{0:08x}  {1}'.format(offset, u' '.join(
+                '{0:02x}'.format(ord(c)) for c in chunk)))
+        lines.append(u'          ^^^^^^^^^^^    ~~~~~~~~~~~       !!!!!')
+    return u'\n'.join(lines)
+
+def _measure(function, text, repeat):
+    best = None
+    for _i in xrange(repeat):
+        start = time.time()
+        result = function(text)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
@@ -0,0 +1,111 @@
+from __future__ import print_function
+import time
+from collections import deque
+from optparse import make_option
+
+import libvirt
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User, Group
+
+from insekta.common.virt import connections, lxc_connections
+from insekta.common.misc import progress_bar
+from insekta.scenario.models import Scenario, RunTaskQueue, ScenarioError
+from insekta.vm.models import VirtualMachineError
+from insekta.network.models import NetworkError
+
+class Command(BaseCommand):
+    args = '<scenario_name> [username ...]'
+    help = ('Starts a scenario for a list of users or a whole group, e.g. '
+            'before a workshop begins')
+    option_list = BaseCommand.option_list + (
+        make_option('--group', dest='group', default=None,
+                    help='Provision runs for all active users of this group'),
+        make_option('--delay', dest='delay', type='float', default=2.0,
+                    help='Seconds to wait between two libvirt operations '
+                         'on the same node'),
+        make_option('--queue', dest='queue', action='store_true',
+                    default=False,
+                    help='Leave creating the domains to the vmd'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('The first arg is the scenario name')
+
+        try:
+            scenario = Scenario.objects.get(name=args[0])
+        except Scenario.DoesNotExist:
+            raise CommandError('No such scenario: {0}'.format(args[0]))
+
+        users = list(User.objects.filter(username__in=args[1:]))
+        if len(users) != len(args[1:]):
+            found = set(user.username for user in users)
+            missing = [name for name in args[1:] if name not in found]
+            raise CommandError('No such users: {0}'.format(
+                    ', '.join(missing)))
+
+        if options['group']:
+            try:
+                group = Group.objects.get(name=options['group'])
+            except Group.DoesNotExist:
+                raise CommandError('No such group: {0}'.format(
+                        options['group']))
+            users.extend(group.user_set.filter(is_active=True))
+
+        if not users:
+            raise CommandError('No users given')
+
+        print('Allocating runs for {0} users ...'.format(len(users)))
+        try:
+            runs = scenario.provision(users)
+        except (ScenarioError, NetworkError), e:
+            raise CommandError(unicode(e))
+        print('{0} runs allocated, {1} users skipped.'.format(
+                len(runs), len(users) - len(runs)))
+
+        if options['queue']:
+            for scenario_run in runs:
+                RunTaskQueue.objects.create(scenario_run=scenario_run,
+                                            action='create')
+            print('Queued {0} runs for the vmd.'.format(len(runs)))
+        elif runs:
+            self._create_domains(runs, options['delay'])
+
+    def _create_domains(self, runs, delay):
+        """Create and start domains, one operation per node and round.
+
+        Every round creates at most one domain per node and then waits
+        `delay` seconds, so no node gets all domains at the same time.
+        """
+        node_queues = {}
+        for scenario_run in runs:
+            node_queues.setdefault(scenario_run.node, deque()).append(
+                    scenario_run)
+
+        print('Creating domains on {0} nodes:'.format(len(node_queues)))
+        progress = progress_bar(len(runs))
+        num_done = 0
+        failed = []
+        while node_queues:
+            for node, queue in node_queues.items():
+                scenario_run = queue.popleft()
+                try:
+                    scenario_run.create_domains()
+                except (VirtualMachineError, libvirt.libvirtError):
+                    failed.append(scenario_run)
+                num_done += 1
+                progress.send(num_done)
+                if not queue:
+                    del node_queues[node]
+            if node_queues:
+                time.sleep(delay)
+        connections.close()
+        lxc_connections.close()
+        print()
+
+        for scenario_run in failed:
+            print('Could not start {0} on node {1}'.format(
+                    unicode(scenario_run), scenario_run.node))
+        print('Done! {0} of {1} domains started.'.format(
+                len(runs) - len(failed), len(runs)))
@@ -0,0 +1,15 @@
+from __future__ import print_function
+
+from django.core.management.base import NoArgsCommand
+
+from insekta.scenario.models import Scoreboard
+
+class Command(NoArgsCommand):
+    help = ('Calculates all scoreboards again, e.g. after scenarios were '
+            'added to or removed from a group')
+
+    def handle_noargs(self, **options):
+        for scoreboard in Scoreboard.objects.select_related('scenario_group'):
+            scoreboard.rebuild()
+            print('{0}: {1} users'.format(unicode(scoreboard),
+                                          scoreboard.get_num_users()))
@@ -1,16 +1,88 @@
 from __future__ import print_function
 import time
 import signal
-from datetime import datetime
+import heapq
+from collections import deque
+from datetime import datetime, timedelta
 
 from django.core.management.base import NoArgsCommand
 from django.conf import settings
 
-from insekta.common.virt import connections
-from insekta.scenario.models import ScenarioRun, RunTaskQueue, ScenarioError
+from insekta.common.virt import connections, lxc_connections
+from insekta.common.misc import parallel_map
+from insekta.scenario.models import (ScenarioRun, RunTaskQueue, ScenarioError,
+                                     get_last_activities)
 from insekta.vm.models import VirtualMachineError
 
 MIN_SLEEP = 1.0
+# Seconds between two loads of new and active runs into the schedule
+SYNC_INTERVAL = 30.0
+# Heartbeats reach the database a bit late, so look back some more
+SYNC_MARGIN = timedelta(minutes=2)
+# Number of expired runs destroyed per node in one round
+EXPIRE_BATCH_SIZE = 4
+
+class ExpirySchedule(object):
+    """Keeps the expiry times of all scenario runs in a heap.
+
+    The schedule is loaded from the database once. Afterwards only runs
+    with a recent ``last_activity``, i.e. new runs and runs with
+    heartbeats, are loaded by :meth:`sync`. The database and the cached
+    heartbeats are asked again when a run seems to have expired, as a
+    heartbeat might have been missed.
+    """
+    def __init__(self, expire_time):
+        self.expire_time = expire_time
+        self._heap = []
+        # Maps run ids to their current expiry, older heap entries of
+        # a run are skipped
+        self._expiry = {}
+        self._last_sync = None
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def schedule(self, run_id, last_activity):
+        expires_at = last_activity + self.expire_time
+        if self._expiry.get(run_id) == expires_at:
+            return
+        self._expiry[run_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, run_id))
+
+    def sync(self):
+        """Load runs that were created or active since the last sync."""
+        sync_time = datetime.today()
+        runs = ScenarioRun.objects.all()
+        if self._last_sync is not None:
+            runs = runs.filter(last_activity__gte=self._last_sync -
+                               SYNC_MARGIN)
+        for run_id, last_activity in runs.values_list('pk', 'last_activity'):
+            self.schedule(run_id, last_activity)
+        self._last_sync = sync_time
+
+    def pop_expired(self):
+        """Remove all expired runs from the schedule and return them."""
+        now = datetime.today()
+        run_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, run_id = heapq.heappop(self._heap)
+            if self._expiry.get(run_id) == expires_at:
+                del self._expiry[run_id]
+                run_ids.append(run_id)
+        if not run_ids:
+            return []
+
+        expired_runs = []
+        deadline = now - self.expire_time
+        scenario_runs = list(ScenarioRun.objects.filter(pk__in=run_ids))
+        last_activities = get_last_activities(scenario_runs)
+        for scenario_run in scenario_runs:
+            last_activity = last_activities[scenario_run.pk]
+            if last_activity < deadline:
+                expired_runs.append(scenario_run)
+            else:
+                self.schedule(scenario_run.pk, last_activity)
+        return expired_runs
 
 class Command(NoArgsCommand):
     help = 'Manages the state changes of virtual machines'
@@ -20,6 +92,9 @@ class Command(NoArgsCommand):
         signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
         signal.signal(signal.SIGTERM, lambda sig, frame: self.stop())
 
+        schedule = ExpirySchedule(settings.SCENARIO_EXPIRE_TIME)
+        expired_runs = deque()
+        next_sync = 0
         last_call = time.time()
         while self.run:
             # Process all open tasks
@@ -30,17 +105,17 @@ class Command(NoArgsCommand):
                     # This can happen if someone manages the vm manually.
                     # We can just ignore it, it does no harm
                     pass
+                task_id = task.pk
                 task.delete()
+                RunTaskQueue.objects.mark_done(task_id)
            
             # Delete expired scenarios
-            expired_runs = ScenarioRun.objects.filter(last_activity__lt=
-                    datetime.today() - settings.SCENARIO_EXPIRE_TIME)
-            for scenario_run in expired_runs:
-                try:
-                    scenario_run.vm.destroy()
-                except VirtualMachineError:
-                    # We have an inconsistent state. See comment above.
-                    pass
+            if time.time() >= next_sync:
+                schedule.sync()
+                next_sync = time.time() + SYNC_INTERVAL
+            expired_runs.extend(schedule.pop_expired())
+            if expired_runs:
+                self._destroy_expired(expired_runs, schedule)
 
             current_time = time.time()
             time_passed = current_time - last_call
@@ -48,39 +123,79 @@ class Command(NoArgsCommand):
                 time.sleep(MIN_SLEEP - time_passed)
             last_call = current_time
         connections.close()
+        lxc_connections.close()
+
+    def _destroy_expired(self, expired_runs, schedule):
+        """Destroy a batch of expired runs in parallel.
+
+        At most EXPIRE_BATCH_SIZE runs per node are destroyed, the others
+        are left for the next rounds. So many expiring runs do not delay
+        the tasks of the users. As runs may have been deleted or used
+        again in the meantime, the batch is loaded again before.
+        """
+        per_node = {}
+        remaining = deque()
+        batch = []
+        for scenario_run in expired_runs:
+            vms = scenario_run.get_vms()
+            node = vms[0].node if vms else None
+            if per_node.get(node, 0) < EXPIRE_BATCH_SIZE:
+                per_node[node] = per_node.get(node, 0) + 1
+                batch.append(scenario_run)
+            else:
+                remaining.append(scenario_run)
+        expired_runs.clear()
+        expired_runs.extend(remaining)
+
+        deadline = datetime.today() - schedule.expire_time
+        runs = ScenarioRun.objects.in_bulk([scenario_run.pk for scenario_run
+                                            in batch])
+        last_activities = get_last_activities(runs.values())
+        batch = []
+        for scenario_run in runs.itervalues():
+            last_activity = last_activities[scenario_run.pk]
+            if last_activity < deadline:
+                batch.append(scenario_run)
+            else:
+                schedule.schedule(scenario_run.pk, last_activity)
+
+        def destroy(scenario_run):
+            try:
+                scenario_run.destroy()
+            except VirtualMachineError:
+                # We have an inconsistent state. See comment above.
+                pass
+        parallel_map(destroy, batch)
 
     def _handle_task(self, task):
         scenario_run = task.scenario_run
-        vm = scenario_run.vm
-
-        db_state = vm.state
-        vm.refresh_state()
-        if vm.state != db_state:
-            vm.save()
+        # All virtual machines of a run are handled in parallel, so the
+        # task takes as long as the slowest virtual machine.
+        scenario_run.refresh_state()
+        state = scenario_run.state
 
         # Scenario run was deleted in a previous task, we need to ignore
         # all further task actions except create
-        if vm.state == 'disabled' and task.action != 'create':
+        if state == 'disabled' and task.action != 'create':
             return
         
         if task.action == 'create':
-            if vm.state == 'disabled':
-                vm.create_domain()
-                vm.start()
+            if state == 'disabled':
+                scenario_run.create_domains()
         elif task.action == 'start':
-            if vm.state == 'stopped':
-                vm.start()
+            if state == 'stopped':
+                scenario_run.start()
         elif task.action == 'stop':
-            if vm.state == 'started':
-                vm.stop()
+            if state == 'started':
+                scenario_run.stop()
         elif task.action == 'suspend':
-            if vm.state == 'started':
-                vm.suspend()
+            if state == 'started':
+                scenario_run.suspend()
         elif task.action == 'resume':
-            if vm.state == 'suspended':
-                vm.resume()
+            if state == 'suspended':
+                scenario_run.resume()
         elif task.action == 'destroy':
-            vm.destroy()
+            scenario_run.destroy()
 
     def stop(self):
         print('Stopping, please wait a few moments.')
@@ -1,15 +1,18 @@
 import re
+import hashlib
 from genshi.builder import tag
 from genshi import Markup
 from creoleparser import Parser, create_dialect, creole11_base
 from django.utils.translation import ugettext as _
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from django.conf import settings
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import HtmlFormatter
 from pygments.util import ClassNotFound
 from insekta.scenario.markup.highlight import highlight_parts
+from insekta.common.misc import LRUCache
 
 def enter_secret(macro, environ, *secrets):
     """Macro for entering a secret. Takes a several secrets as args.
@@ -45,17 +48,31 @@ def enter_secret(macro, environ, *secrets):
        A function that calculates the secret's security token. Takes an user
        and a secret.
 
+    ``secret_tokens``
+       Optional dictionary mapping secrets to their security tokens. Missing
+       tokens are calculated with ``secret_token_function`` and added, so
+       every token is only calculated once per render.
+
     ``csrf_token``
        Django's CSRF token. Use :func:`django.middleware.csrf.get_token` to
        get it.
+
+    If the environ contains the key ``overlay``, the user dependent parts
+    are left out, see :mod:`insekta.scenario.markup.overlay`.
     """
+    if 'overlay' in environ:
+        return environ['overlay'].defer('enterSecret', secrets, macro)
+    return enter_secret_tag(macro.parsed_body(), environ, secrets)
+
+def enter_secret_tag(body, environ, secrets):
+    """Build the form of :func:`enter_secret` around body."""
     target = environ['enter_secret_target']
     user = environ['user']
     
     # If all secrets are already submitted, change css class
     solved = all(secret in environ['submitted_secrets'] for secret in secrets)
     css_class = 'enter_secret secret_solved' if solved else 'enter_secret'
-    secret_div = tag.div(macro.parsed_body(), class_=css_class)
+    secret_div = tag.div(body, class_=css_class)
     
     if not solved:
         # If there are no secrets in the arguments, we will accept all secrets
@@ -64,8 +81,13 @@ def enter_secret(macro, environ, *secrets):
         
         form = tag.form(method='post', action=target)
         
+        tokens = environ.setdefault('secret_tokens', {})
         for secret in secrets:
-            secret_token = environ['secret_token_function'](user, secret)
+            try:
+                secret_token = tokens[secret]
+            except KeyError:
+                secret_token = environ['secret_token_function'](user, secret)
+                tokens[secret] = secret_token
             form.append(tag.input(name='secret_token', value=secret_token,
                                   type='hidden'))
     
@@ -102,23 +124,43 @@ def require_secret(macro, environ, *secrets):
     ``submitted_secrets``
        A set of secrets for this scenario which were submitted by the user.
     """
+    if 'overlay' in environ:
+        return environ['overlay'].defer('requireSecret', secrets, macro)
+
     show_content = any(x in environ['submitted_secrets'] for x in secrets)
 
     if show_content:
         return macro.parsed_body()
     else:
-        dragons = tag.strong(_('Here be dragons.'))
-        text = _('This content is hidden, '
-                  'you need to submit a specific secret in order to show it.')
-        return tag.div(tag.p(dragons, ' ', text), class_='require_secret')
+        return hidden_content_tag()
+
+def hidden_content_tag():
+    """Build the replacement for content hidden by :func:`require_secret`."""
+    dragons = tag.strong(_('Here be dragons.'))
+    text = _('This content is hidden, '
+              'you need to submit a specific secret in order to show it.')
+    return tag.div(tag.p(dragons, ' ', text), class_='require_secret')
 
 def spoiler(macro, environ):
     """Macro for spoiler. Showing and hiding it is done via javascript."""
     return tag.div(macro.parsed_body(), class_='spoiler')
 
-def ip(macro, environ):
-    """Macro for the virtual machine's ip."""
-    ip = environ.get('ip')
+def ip(macro, environ, name=None):
+    """Macro for the virtual machine's ip.
+
+    Takes the name of the virtual machine as optional argument, otherwise
+    the first virtual machine of the scenario is used.
+    """
+    if 'overlay' in environ:
+        return environ['overlay'].defer('ip', (name, ))
+    return ip_tag(environ, name)
+
+def ip_tag(environ, name=None):
+    """Build the element of :func:`ip`."""
+    if name is None:
+        ip = environ.get('ip')
+    else:
+        ip = environ.get('ips', {}).get(name)
     if not ip:
         ip = '127.0.0.1'
     return tag.span(ip, class_='ip')
@@ -126,12 +168,50 @@ def ip(macro, environ):
 def code(macro, environ, lang='text', linenos=False):
     """Macro for syntax highlighting using pygments."""
     try:
-        lexer = get_lexer_by_name(lang)
+        return Markup(highlight_code(macro.body, lang, linenos == 'yes'))
     except ClassNotFound:
         return tag.div(_('No such language: {lang}').format(lang=lang),
                        class_='error')
-    formatter = HtmlFormatter(linenos=linenos == 'yes')
-    return Markup(highlight(macro.body, lexer, formatter))
+
+_lexers = {}
+_formatters = {
+    True: HtmlFormatter(linenos=True),
+    False: HtmlFormatter(linenos=False)
+}
+code_cache = LRUCache(getattr(settings, 'SCENARIO_CODE_CACHE_SIZE', 512))
+def highlight_code(body, lang, linenos):
+    """Highlight some code with pygments and return it as html.
+
+    Results are kept in :data:`code_cache` and in Django's cache, so
+    rendering a scenario in ``loadscenario`` also warms the cache for the
+    web application. Lexers and formatters are shared between calls.
+
+    :raises: :class:`pygments.util.ClassNotFound` if there is no lexer
+             for the language.
+    """
+    key = (body, lang, linenos)
+    result = code_cache.get(key)
+    if result is not None:
+        return result
+
+    if isinstance(body, unicode):
+        body_hash = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    else:
+        body_hash = hashlib.sha1(body).hexdigest()
+    cache_key = 'scenario_code:{0}:{1:d}:{2}'.format(
+            hashlib.sha1(lang.encode('utf-8')).hexdigest(), linenos,
+            body_hash)
+    result = cache.get(cache_key)
+    if result is None:
+        try:
+            lexer = _lexers[lang]
+        except KeyError:
+            lexer = _lexers[lang] = get_lexer_by_name(lang)
+        result = highlight(body, lexer, _formatters[linenos])
+        cache.set(cache_key, result,
+                  getattr(settings, 'SCENARIO_RENDER_CACHE_TIMEOUT', 86400))
+    code_cache.set(key, result)
+    return result
 
 _highlight_colors = {
     '!': '#d00',
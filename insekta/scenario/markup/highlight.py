@@ -1,3 +1,4 @@
+import re
 from itertools import islice, chain
 
 def highlight_parts(text, highlight, chars=['^', '~', '-', '!']):
@@ -12,6 +13,66 @@ def highlight_parts(text, highlight, chars=['^', '~', '-', '!']):
           '''
           highlight_parts(text, lambda x, c: '<strong>' + x + '</strong>')
 
+    A marker line highlights the line above it. Every run of the same
+    marker char is highlighted with that char.
+    """
+    marker_re = _get_marker_re(chars)
+    lines = text.splitlines()
+    is_marker = [marker_re.match(line) is not None for line in lines]
+    # Two marker lines in a row are handled in a peculiar way by the
+    # reference implementation, leave them to it
+    if any(is_marker[i] and is_marker[i + 1] for i in xrange(len(lines) - 1)):
+        return _highlight_parts_reference(text, highlight, chars)
+
+    result = []
+    num_lines = len(lines)
+    for i, line in enumerate(lines):
+        if is_marker[i]:
+            continue
+        if i + 1 == num_lines or not is_marker[i + 1]:
+            result.append(line)
+            continue
+
+        parts = []
+        end = 0
+        for run in _run_re.finditer(lines[i + 1]):
+            start, end = run.span()
+            char = run.group(1)
+            if char == ' ':
+                parts.append(line[start:end])
+            else:
+                parts.append(highlight(line[start:end], char))
+        # Text line is longer than the marker line
+        if end < len(line):
+            parts.append(line[end:])
+        result.append(''.join(parts))
+    return u'\n'.join(result)
+
+_run_re = re.compile(r'(.)\1*')
+_marker_res = {}
+
+def _get_marker_re(chars):
+    """Return a regex matching lines consisting only of markers."""
+    key = frozenset(chars)
+    try:
+        return _marker_res[key]
+    except KeyError:
+        pattern = u'[ {0}]+$'.format(u''.join(re.escape(c) for c in key))
+        marker_re = _marker_res[key] = re.compile(pattern)
+        return marker_re
+
+def _highlight_parts_reference(text, highlight, chars=['^', '~', '-', '!']):
+    """Reference implementation of :func:`highlight_parts`::
+
+          text = '''
+          Lorem ipsum dolor si amet
+                ^^^^^ ~~~~~    ^^^^
+          consectetur adipiscing elit
+          Mauris ac magna a nisl ornare
+                 --------   !!!!
+          '''
+          highlight_parts(text, lambda x, c: '<strong>' + x + '</strong>')
+
     """
     highlight_fn = lambda x, char: x if char == ' ' else highlight(x, char)
     chars = frozenset(chain([' '], chars))
@@ -0,0 +1,167 @@
+"""Cached rendering of scenario descriptions.
+
+Nearly all of a rendered description is the same for every user. Only the
+``ip``, ``enterSecret`` and ``requireSecret`` macros depend on the user.
+:func:`render_static` renders the description once and leaves markers for
+these macros, :func:`apply_overlay` fills them in for one user by a few
+string substitutions.
+
+:func:`compile_description` additionally collects the secrets, its result
+is stored with the scenario by ``loadscenario``, so the description is
+only parsed at request time if an inline ``requireSecret`` has to be
+hidden, see :func:`apply_overlay`.
+"""
+import re
+import json
+import hashlib
+
+from genshi.builder import tag
+from genshi import Markup
+from django.core.cache import cache
+from django.conf import settings
+
+from insekta.scenario.markup.creole import (render_scenario, enter_secret_tag,
+                                            hidden_content_tag, ip_tag)
+
+# Increase it whenever the static render or its sections change
+FORMAT_VERSION = 2
+
+_section_re = re.compile(r'<!--insekta:(\d+)-->(.*?)<!--/insekta:\1-->',
+                         re.DOTALL)
+
+class OverlayError(Exception):
+    pass
+
+class SectionCollector(object):
+    """Collects user dependent sections while rendering the description.
+
+    Put an instance into the environ as ``overlay``.
+    """
+    def __init__(self):
+        self.sections = []
+        self.secrets = set()
+
+    def defer(self, kind, args, macro=None):
+        """Register a section and return it surrounded by markers.
+
+        :param macro: The macro object of a bodied macro. Its body is
+                      rendered between the markers.
+        """
+        section_id = len(self.sections)
+        isblock = macro is not None and macro.isblock
+        self.sections.append((kind, tuple(args), isblock))
+        if kind == 'enterSecret':
+            self.secrets.update(args)
+        start = u'<!--insekta:{0}-->'.format(section_id)
+        end = u'<!--/insekta:{0}-->'.format(section_id)
+        if macro is None:
+            return tag(Markup(start + end))
+
+        # creoleparser puts Markup outside of paragraphs, like the div of
+        # enterSecret, and wraps fragments of block macros into paragraphs.
+        # apply_overlay adds the paragraph for requireSecret instead.
+        body = macro.parsed_body()
+        if kind == 'enterSecret' or isblock:
+            return Markup(start + _render(body) + end)
+        return tag(Markup(start), body, Markup(end))
+
+def render_static(text):
+    """Render the user independent part of a description.
+
+    :return: Tuple of the rendered description as unicode and a list of
+             sections, to be used with :func:`apply_overlay`.
+    """
+    compiled = compile_description(text)
+    return compiled['html'], compiled['sections']
+
+def _render(element):
+    # Like render_scenario, which keeps white space
+    return element.generate().render('xhtml', encoding=None,
+                                     strip_whitespace=False)
+
+def compile_description(text):
+    """Compile a description into a serialisable dictionary.
+
+    The dictionary contains the static render as ``html``, its ``sections``,
+    all ``secrets`` used by ``enterSecret`` macros and the ``version`` of
+    the format. It only consists of strings, lists and numbers, so it can
+    be stored as JSON.
+    """
+    collector = SectionCollector()
+    html = render_scenario(text, environ={'overlay': collector})
+    if isinstance(html, str):
+        html = html.decode('utf-8')
+    return {
+        'html': html,
+        'sections': [[kind, list(args), isblock] for kind, args, isblock
+                     in collector.sections],
+        'secrets': sorted(collector.secrets),
+        'version': FORMAT_VERSION
+    }
+
+def description_hash(text):
+    """Return the SHA1 hash of a description as hex string."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+def apply_overlay(html, sections, environ):
+    """Fill in the user dependent sections of a static render.
+
+    Hiding an inline ``requireSecret`` makes creoleparser split the
+    surrounding paragraph, which the static render can't reproduce.
+    :class:`OverlayError` is raised instead, render the description
+    with :func:`render_scenario` then.
+
+    :param environ: The same environ :func:`render_scenario` requires.
+    """
+    def replace(match):
+        kind, args, isblock = sections[int(match.group(1))]
+        if kind == 'ip':
+            return _render(ip_tag(environ, *args))
+        elif kind == 'requireSecret':
+            if not any(x in environ['submitted_secrets'] for x in args):
+                if not isblock:
+                    raise OverlayError('Inline section can not be hidden')
+                return _render(hidden_content_tag())
+
+        # Nested sections are filled in before their parent
+        body = _section_re.sub(replace, match.group(2))
+        if kind == 'enterSecret':
+            return _render(enter_secret_tag(Markup(body), environ, args))
+        elif isblock:
+            return u'<p>' + body + u'</p>'
+        return body
+
+    return _section_re.sub(replace, html)
+
+def render_cached(scenario, environ):
+    """Render the description of a scenario for a user.
+
+    The static render is cached by scenario name, format version and the
+    description hash stored with the scenario, which changes whenever the
+    description is compiled. On a cache miss the precompiled description
+    of the scenario is used; it is compiled again if it is missing or
+    outdated.
+    """
+    static_render = None
+    if scenario.description_hash:
+        static_render = cache.get(_cache_key(scenario))
+    if static_render is None:
+        compiled = None
+        if scenario.compiled_description:
+            compiled = json.loads(scenario.compiled_description)
+        if not compiled or compiled.get('version') != FORMAT_VERSION:
+            compiled = scenario.compile_description(save=True)
+        static_render = compiled['html'], compiled['sections']
+        cache.set(_cache_key(scenario), static_render,
+                  getattr(settings, 'SCENARIO_RENDER_CACHE_TIMEOUT', 86400))
+    html, sections = static_render
+    try:
+        return apply_overlay(html, sections, environ)
+    except OverlayError:
+        return render_scenario(scenario.description, environ=environ)
+
+def _cache_key(scenario):
+    return 'scenario_description:{0}:{1}:{2}'.format(FORMAT_VERSION,
+            scenario.name, scenario.description_hash)
@@ -1,18 +1,300 @@
-from creoleparser import Parser, create_dialect, creole11_base
+"""Extraction of the secrets of a scenario description.
 
-def enter_secret(macro, environ, *secrets):
+Secrets are the arguments of the ``enterSecret`` macros. Instead of
+rendering the whole description, :func:`extract_secrets` scans it for the
+few constructs that decide which macros creoleparser would run:
+preformatted blocks, nowiki text, block macros and the ``enterSecret``
+macro itself. All other macros just return their body when extracting
+secrets, inline ones do not need to be tracked.
+
+creoleparser replaces a block macro by its body and parses the whole text
+again. Here the lines starting with ``<<``, ``{{{`` or ``}}}`` are found
+first and the tags of each macro name are matched with a stack, like
+creoleparser counts nested tags. A forward pass over the block starts then
+only records which lines a block macro removes and scans the text between
+``enterSecret`` macros and preformatted blocks once, with these changes.
+"""
+import re
+import heapq
+
+from creoleparser import Parser, create_dialect, creole11_base, parse_args
+
+# A macro name continues, so this is not an enterSecret macro
+_name_end = r'(?![a-zA-Z0-9]|[-.][a-zA-Z0-9])'
+
+# Block level: lines starting or ending block macros and preformatted blocks
+_block_line_re = re.compile(r'^(?:<<|\{\{\{|\}\}\})', re.MULTILINE)
+_macro_name_re = re.compile(r'[a-zA-Z][a-zA-Z0-9]*(?:[-.][a-zA-Z0-9]+)*')
+_name_chars_re = re.compile(r'[a-zA-Z0-9.-]*')
+# Rest of an opening tag after the name. Nested opening tags are counted
+# by creoleparser even if the name continues or they end with a slash.
+_open_rest_re = re.compile(r'(?P<args>(?![^\n]*>>[^\n]*>>)[ \S]*?)'
+                           r'(?<!/)>>\s*?\n')
+_nested_rest_re = re.compile(r'(?![^\n]*>>[^\n]*>>)[ \S]*?>>\s*?\n')
+_close_re = re.compile(r'<</(?P<name>[a-zA-Z][a-zA-Z0-9]*'
+                       r'(?:[-.][a-zA-Z0-9]+)*)>>[^\S\n]*$', re.MULTILINE)
+_pre_start_re = re.compile(r'\{\{\{[^\S\n]*\n')
+_pre_end_re = re.compile(r'\}\}\}[^\S\n]*$', re.MULTILINE)
+
+# Table rows, headings and horizontal rules are blocks of a single line,
+# list items start a new block
+_single_line_re = re.compile(r'[ \t]*(?:\||=|\s*----\s*$)')
+_list_item_re = re.compile(r'[ \t]*(?:\*(?!\*)|#(?!#))')
+
+# Inline level: nowiki text and enterSecret macros
+_inline_re = re.compile(r'(?<!~)(?:(?P<nowiki>\{\{\{)|<<enterSecret%s)'
+                        % _name_end)
+_nowiki_re = re.compile(r'\{\{\{.+?\}*\}\}\}', re.DOTALL)
+_bodied_open_re = re.compile(r'<<enterSecret(?P<args>[ \S]*?)(?<!/)>>')
+_inline_tag_re = re.compile(r'(?<!~)(?:(?P<open><<enterSecret[ \S]*?>>)'
+                            r'|<</enterSecret>>)')
+_inline_close = '<</enterSecret>>'
+
+# Arguments consisting only of quoted strings and words are split here,
+# everything else is left to creoleparser
+_simple_args_re = re.compile(r'''^\s*(?:(?:'[^']*'|"[^"]*"|[^\s'"=~]+)
+                                 (?:\s+|$))*$''', re.VERBOSE)
+_arg_re = re.compile(r''''([^']*)'|"([^"]*)"|([^\s'"=~]+)''')
+
+def extract_secrets(text):
+    """Return the set of secrets used by enterSecret macros in text.
+
+    The result is the same as the one of :func:`_extract_secrets_creole`,
+    but the text is only scanned, not parsed.
+    """
+    secrets = set()
+    _scan_blocks(text, secrets)
+    return secrets
+
+def _scan_blocks(text, secrets):
+    starts, closes, closes_by_name, matches, matched_by = _block_lines(text)
+    removed = set()
+    # Changes of the text behind pos as (start, end, replacement)
+    changes = []
+    pos = 0
+    for start, end, names in starts:
+        if start < pos:
+            continue
+        if names is None:
+            _scan_inline(_changed_text(text, pos, start, changes), secrets)
+            pos = end
+            _drop_changes(changes, pos)
+            continue
+
+        # The longest name with a closing tag after a non empty body wins
+        for name in names:
+            close = _last_close(closes_by_name[name], removed)
+            if close is not None and closes[close][0] > end:
+                break
+        else:
+            continue
+        # Like creoleparser the body reaches until the last closing tag. It
+        # ends at the first closing tag that is not balanced by a nested
+        # opening tag, if there is one. The last closing tag is then
+        # parsed again, followed by an empty line.
+        match = matches.get((start, name))
+        if match == close:
+            match = None
+        if match is not None:
+            close_end = closes[close][1]
+            heapq.heappush(changes, (close_end, close_end, '\n'))
+
+        if name == 'enterSecret':
+            _scan_inline(_changed_text(text, pos, start, changes), secrets)
+            args = _open_rest_re.match(text, start + len(name) + 2)
+            _add_secrets(args.group('args'), secrets)
+            pos = closes[close if match is None else match][1]
+            _drop_changes(changes, pos)
+        else:
+            # The body replaces the macro, the matched closing tag leaves
+            # an empty line
+            heapq.heappush(changes, (start, end, ''))
+            if match is None:
+                # Nested opening tags matched with this closing tag have
+                # no closing tag left
+                matches.pop(matched_by.get(close), None)
+                match = close
+            removed.add(match)
+            heapq.heappush(changes, closes[match][:2] + ('', ))
+    _scan_inline(_changed_text(text, pos, len(text), changes), secrets)
+
+def _block_lines(text):
+    """Find the lines starting and ending block macros and preformatted
+    blocks.
+
+    :return: Tuple of the block starts as ``(start, end, names)`` ordered
+             by start, the closing tags as ``(start, end, name)``, the
+             indexes of the closing tags by name, a dictionary mapping
+             ``(start, name)`` of an opening tag to the index of its
+             matching closing tag and the reverse of it. ``names`` are the
+             possible macro names of an opening tag, longest first, or
+             None for a preformatted block.
+    """
+    lines = []
+    closes = []
+    closes_by_name = {}
+    pre_ends = []
+    for line in _block_line_re.finditer(text):
+        pos = line.start()
+        if text.startswith('<</', pos):
+            close = _close_re.match(text, pos)
+            if close:
+                closes_by_name.setdefault(close.group('name'),
+                                          []).append(len(closes))
+                lines.append((pos, 'close', len(closes)))
+                closes.append((pos, close.end(), close.group('name')))
+        elif text.startswith('<<', pos):
+            lines.append((pos, 'open', None))
+        elif text.startswith('{{{', pos):
+            pre_start = _pre_start_re.match(text, pos)
+            if pre_start:
+                lines.append((pos, 'pre', pre_start.end()))
+        else:
+            pre_end = _pre_end_re.match(text, pos)
+            if pre_end:
+                pre_ends.append((pos, pre_end.end()))
+
+    starts = []
+    matches = {}
+    matched_by = {}
+    stacks = dict((name, []) for name in closes_by_name)
+    pre_end_index = 0
+    for pos, kind, data in lines:
+        if kind == 'close':
+            stack = stacks[closes[data][2]]
+            if stack:
+                matches[stack[-1]] = data
+                matched_by[data] = stack.pop()
+        elif kind == 'pre':
+            # The body must not be empty
+            while (pre_end_index < len(pre_ends) and
+                   pre_ends[pre_end_index][0] <= data):
+                pre_end_index += 1
+            if pre_end_index < len(pre_ends):
+                starts.append((pos, pre_ends[pre_end_index][1], None))
+        else:
+            chars_end = _name_chars_re.match(text, pos + 2).end()
+            if not _nested_rest_re.match(text, chars_end):
+                continue
+            for name in _known_prefixes(text[pos + 2:chars_end], stacks):
+                stacks[name].append((pos, name))
+            name = _macro_name_re.match(text, pos + 2)
+            rest = _open_rest_re.match(text, chars_end)
+            if name and rest:
+                names = _known_prefixes(name.group(), stacks)
+                names.reverse()
+                starts.append((pos, rest.end(), names))
+    return starts, closes, closes_by_name, matches, matched_by
+
+def _known_prefixes(name, names):
+    return [name[:i] for i in xrange(1, len(name) + 1) if name[:i] in names]
+
+def _last_close(indexes, removed):
+    while indexes and indexes[-1] in removed:
+        indexes.pop()
+    if indexes:
+        return indexes[-1]
+
+def _changed_text(text, start, end, changes):
+    """Return text[start:end] with the changes before end applied."""
+    pieces = []
+    while changes and changes[0][0] < end:
+        change_start, change_end, replacement = heapq.heappop(changes)
+        pieces.append(text[start:change_start])
+        pieces.append(replacement)
+        start = change_end
+    pieces.append(text[start:end])
+    return text[:0].join(pieces)
+
+def _drop_changes(changes, pos):
+    while changes and changes[0][0] < pos:
+        heapq.heappop(changes)
+
+def _scan_inline(text, secrets):
+    """Scan text outside of block macros and preformatted blocks.
+
+    Inline macros do not span blocks like paragraphs or list items, so
+    every block is scanned for its own.
+    """
+    block = []
+    for line in text.split('\n'):
+        if not line.strip() or _single_line_re.match(line):
+            if block:
+                _scan_paragraph('\n'.join(block), secrets)
+                block = []
+            if line.strip():
+                _scan_paragraph(line, secrets)
+            continue
+        if block and _list_item_re.match(line):
+            _scan_paragraph('\n'.join(block), secrets)
+            block = []
+        block.append(line)
+    if block:
+        _scan_paragraph('\n'.join(block), secrets)
+
+def _scan_paragraph(text, secrets):
+    pos = 0
+    # Position of the last closing tag, it ends the body of any bodied macro
+    last_close = text.rfind(_inline_close)
+    while last_close > 0 and text[last_close - 1] == '~':
+        last_close = text.rfind(_inline_close, 0, last_close)
+    while True:
+        match = _inline_re.search(text, pos)
+        if not match:
+            break
+        start = match.start()
+        if match.group('nowiki'):
+            nowiki = _nowiki_re.match(text, start)
+            pos = nowiki.end() if nowiki else start + 1
+            continue
+
+        bodied = _bodied_open_re.match(text, start)
+        if bodied and last_close > bodied.end():
+            end = _find_inline_end(text, bodied.end(), last_close)
+            _add_secrets(bodied.group('args'), secrets)
+            pos = end
+        else:
+            # Without a body it is an unknown macro
+            pos = start + 1
+
+def _find_inline_end(text, pos, last_close):
+    depth = 0
+    for match in _inline_tag_re.finditer(text, pos, last_close):
+        if match.group('open'):
+            depth -= 1
+        else:
+            depth += 1
+            if depth > 0:
+                return match.end()
+    return last_close + len(_inline_close)
+
+def _add_secrets(arg_string, secrets):
+    if _simple_args_re.match(arg_string):
+        args = [a or b or c for a, b, c in _arg_re.findall(arg_string)]
+    else:
+        args, kwargs = parse_args(arg_string)
+        # enterSecret takes no keyword arguments, so creoleparser
+        # would show a macro error instead
+        if kwargs:
+            return
+    secrets.update(args)
+
+def _enter_secret(macro, environ, *secrets):
     environ['secrets'].update(secrets)
 
-def macro_func(name, argument, body, type, environ):
+def _macro_func(name, argument, body, type, environ):
     return body
 
-_dialect = create_dialect(creole11_base, macro_func=macro_func,
-        bodied_macros={'enterSecret': enter_secret},)
+_dialect = create_dialect(creole11_base, macro_func=_macro_func,
+        bodied_macros={'enterSecret': _enter_secret},)
 _render = Parser(dialect=_dialect, method='xhtml')
 
-def extract_secrets(text):
+def _extract_secrets_creole(text):
+    """Extract the secrets by rendering the text with creoleparser.
+
+    This is the reference for :func:`extract_secrets`.
+    """
     environ = {'secrets': set()}
     # Parse to populate environ['secrets'], discard xhtml
     _render(text, environ=environ)
     return environ['secrets']
-
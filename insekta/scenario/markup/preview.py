@@ -0,0 +1,142 @@
+"""Incremental preview of scenario descriptions for the editor.
+
+The description is split into its top level blocks. Every block is rendered
+for its own and cached by a hash of its text, so while the author is typing
+only the block that changed has to be rendered again.
+"""
+import re
+import hashlib
+
+from django.core.cache import cache
+from django.conf import settings
+
+from insekta.scenario.markup.creole import render_scenario
+from insekta.scenario.markup.parsesecrets import extract_secrets
+
+_blank_line_re = re.compile(r'^\s*$')
+_pre_start_re = re.compile(r'^\{\{\{\s*$')
+_pre_end_re = re.compile(r'^\}\}\}\s*$')
+_macro_start_re = re.compile(r'^<<([a-zA-Z][a-zA-Z0-9]*(?:[-.][a-zA-Z0-9]+)*)'
+                             r'.*?(?<!/)>>\s*$')
+_macro_end_re = re.compile(r'^<</([a-zA-Z][a-zA-Z0-9]*(?:[-.][a-zA-Z0-9]+)*)'
+                           r'>>\s*$', re.MULTILINE)
+
+# Only these macros depend on the submitted secrets
+_secret_macro_re = re.compile(r'<<(?:enterSecret|requireSecret)\b')
+
+def split_blocks(text):
+    """Split a description into top level blocks.
+
+    Blocks are separated by blank lines. Preformatted blocks and block
+    macros are kept together, even if they contain blank lines.
+    """
+    # A macro without a closing tag has no body, like <<ip>>
+    closing_tags = {}
+    for name in _macro_end_re.findall(text):
+        closing_tags[name] = closing_tags.get(name, 0) + 1
+
+    blocks = []
+    block = []
+    open_macros = []
+    in_pre = False
+    for line in text.splitlines():
+        if in_pre:
+            in_pre = not _pre_end_re.match(line)
+        elif _pre_start_re.match(line):
+            in_pre = True
+        elif _blank_line_re.match(line):
+            if not open_macros:
+                if block:
+                    blocks.append(u'\n'.join(block))
+                    block = []
+                continue
+        else:
+            start = _macro_start_re.match(line)
+            end = _macro_end_re.match(line)
+            if start:
+                name = start.group(1)
+                if closing_tags.get(name, 0) > open_macros.count(name):
+                    open_macros.append(name)
+            elif end:
+                name = end.group(1)
+                closing_tags[name] -= 1
+                if name in open_macros:
+                    while open_macros.pop() != name:
+                        pass
+        block.append(line)
+    if block:
+        blocks.append(u'\n'.join(block))
+    return blocks
+
+def block_key(block, environ):
+    """Return the cache key for a rendered block.
+
+    Blocks with secret macros depend on the user and the secrets, all
+    other blocks only on their text.
+    """
+    block_hash = _block_hash(block)
+    if _secret_macro_re.search(block):
+        secrets = u'\n'.join([unicode(environ['user'].pk)] +
+                             sorted(environ['all_secrets']) + [u''] +
+                             sorted(environ['submitted_secrets']))
+        block_hash += ':' + hashlib.sha1(secrets.encode('utf-8')).hexdigest()
+    return 'scenario_preview:' + block_hash
+
+def extract_block_secrets(blocks):
+    """Return the secrets used by enterSecret macros in blocks.
+
+    The secrets of every block are cached by a hash of its text, so only
+    blocks that changed are scanned again.
+    """
+    blocks = dict(('scenario_preview_secrets:' + _block_hash(block), block)
+                  for block in blocks if 'enterSecret' in block)
+    block_secrets = cache.get_many(blocks.keys()) if blocks else {}
+    extracted = {}
+    for key, block in blocks.iteritems():
+        if key not in block_secrets:
+            block_secrets[key] = extracted[key] = sorted(
+                    extract_secrets(block))
+    if extracted:
+        cache.set_many(extracted, getattr(settings,
+                'SCENARIO_PREVIEW_CACHE_TIMEOUT', 60 * 60))
+    secrets = set()
+    for value in block_secrets.itervalues():
+        secrets.update(value)
+    return secrets
+
+def render_blocks(blocks, environ, known_keys=()):
+    """Render a description block by block.
+
+    :param blocks: The blocks of the description as returned by
+                   :func:`split_blocks`.
+    :param known_keys: Keys of blocks the client already shows. They are
+                       not rendered again.
+    :return: Tuple of the list of block keys in document order and a
+             dictionary mapping the keys of the other blocks to their
+             rendered html.
+    """
+    known_keys = set(known_keys)
+    keys = []
+    unknown_blocks = {}
+    for block in blocks:
+        key = block_key(block, environ)
+        keys.append(key)
+        if key not in known_keys:
+            unknown_blocks[key] = block
+
+    fragments = (cache.get_many(unknown_blocks.keys()) if unknown_blocks
+                 else {})
+    rendered = {}
+    for key, block in unknown_blocks.iteritems():
+        if key not in fragments:
+            html = render_scenario(block, environ=environ)
+            if isinstance(html, str):
+                html = html.decode('utf-8')
+            fragments[key] = rendered[key] = html
+    if rendered:
+        cache.set_many(rendered, getattr(settings,
+                'SCENARIO_PREVIEW_CACHE_TIMEOUT', 60 * 60))
+    return keys, fragments
+
+def _block_hash(block):
+    return hashlib.sha1(block.encode('utf-8')).hexdigest()
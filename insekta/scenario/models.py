@@ -1,16 +1,26 @@
+import sys
 import random
 import hmac
 import hashlib
-from datetime import datetime
-
-from django.db import models
-from django.db.models.signals import post_save, post_delete
+import heapq
+import json
+import time
+from datetime import datetime, timedelta
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, post_syncdb
 from django.conf import settings
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
+from insekta.common.misc import parallel_map
+from insekta.scenario.markup.overlay import (compile_description,
+                                             description_hash)
 from insekta.network.models import Address
-from insekta.vm.models import VirtualMachine, BaseImage
+from insekta.vm.models import (VirtualMachine, BaseImage, RUN_STATE_CHOICES,
+                               BACKEND_CHOICES)
 
 AVAILABLE_TASKS = {
     'create': 'Create VM',
@@ -31,9 +41,9 @@ class Scenario(models.Model):
     name = models.CharField(max_length=80, unique=True)
     title = models.CharField(max_length=200)
     description = models.TextField()
+    compiled_description = models.TextField(blank=True, default='')
+    description_hash = models.CharField(max_length=40, blank=True)
     num_secrets = models.IntegerField()
-    memory = models.IntegerField()
-    image = models.OneToOneField(BaseImage)
     enabled = models.BooleanField(default=False)
 
     class Meta:
@@ -44,6 +54,25 @@ class Scenario(models.Model):
     def __unicode__(self):
         return self.title
 
+    def compile_description(self, save=False):
+        """Precompile the description and store it in this scenario.
+
+        The result is used by :func:`insekta.scenario.markup.overlay.
+        render_cached` instead of parsing the description again.
+
+        :param save: Write the compiled description to the database,
+                     leaving the other fields alone.
+        :return: The compiled description as dictionary.
+        """
+        compiled = compile_description(self.description)
+        self.compiled_description = json.dumps(compiled)
+        self.description_hash = description_hash(self.description)
+        if save and self.pk is not None:
+            Scenario.objects.filter(pk=self.pk).update(
+                    compiled_description=self.compiled_description,
+                    description_hash=self.description_hash)
+        return compiled
+
     def get_secrets(self):
         """Return a frozenset of secrets as strings."""
         return frozenset(secret.secret for secret in self.secret_set.all())
@@ -53,38 +82,51 @@ class Scenario(models.Model):
 
         :param user: Instance of :class:`django.contrib.auth.models.User`.
         """
-        submitted_secrets = SubmittedSecret.objects.filter(user=user,
-                secret__scenario=self)
-        return frozenset(sub.secret.secret for sub in submitted_secrets)
+        return frozenset(SubmittedSecret.objects.filter(user=user,
+                secret__scenario=self).values_list('secret__secret',
+                                                   flat=True))
     
     def submit_secret(self, user, secret, tokens=None):
         """Submit a secret for a user.
 
         :param user: Instance of :class:`django.contrib.auth.models.User`.
         :param secret: The secret as string.
-        :param tokens: A list of security tokens calculated by the function
+        :param tokens: A set of security tokens calculated by the function
                        :func:`insekta.scenario.models.calculate_secret_token`.
                        The secret will only be accepted, if it's token is
-                       inside this list.
+                       inside this set.
         :rtype: :class:`insekta.scenario.models.SubmittedSecret`
         """
+        valid_token = calculate_secret_token(user, secret)
+        if tokens is not None and valid_token not in tokens:
+            raise InvalidSecret(_('This secret is invalid!'))
+
         try:
             secret_obj = Secret.objects.get(scenario=self, secret=secret)
         except Secret.DoesNotExist:
             raise InvalidSecret(_('This secret is invalid!'))
-        else:
-            valid_token = calculate_secret_token(user, secret)
-            if tokens is not None and valid_token not in tokens:
-                raise InvalidSecret(_('This secret is invalid!'))
-            
-            if secret in self.get_submitted_secrets(user):
-                raise InvalidSecret(_('This secret was already submitted!'))
-            
-            return SubmittedSecret.objects.create(secret=secret_obj, user=user)
+
+        # The unique constraint on user and secret detects secrets that were
+        # already submitted, even if they are submitted at the same time.
+        # The progress is updated in the same transaction by the signal.
+        try:
+            with transaction.commit_on_success():
+                return SubmittedSecret.objects.create(secret=secret_obj,
+                                                      user=user)
+        except IntegrityError:
+            raise InvalidSecret(_('This secret was already submitted!'))
 
     def get_nodes(self):
-        """Return a list containing all nodes this scenario can run on."""
-        return settings.LIBVIRT_NODES.keys()
+        """Return a list containing all nodes this scenario can run on.
+
+        Scenarios with LXC containers can only run on nodes that have
+        an LXC connection in ``settings.LIBVIRT_LXC_NODES``.
+        """
+        nodes = settings.LIBVIRT_NODES.keys()
+        if self.machines.filter(backend='lxc').exists():
+            lxc_nodes = getattr(settings, 'LIBVIRT_LXC_NODES', {})
+            nodes = [node for node in nodes if node in lxc_nodes]
+        return nodes
 
     def start(self, user, node=None):
         """Start this scenario for the given user.
@@ -98,10 +140,74 @@ class Scenario(models.Model):
         if node is None:
             node = random.choice(self.get_nodes())
 
-        vm = VirtualMachine.objects.create(node=node, memory=self.memory,
-                base_image=self.image, address=Address.objects.get_free())
+        machines = list(self.machines.all())
+        if not machines:
+            raise ScenarioError('Scenario has no virtual machines')
+
+        with transaction.commit_on_success():
+            addresses = Address.objects.get_free_many(len(machines))
+            scenario_run = ScenarioRun.objects.create(user=user,
+                                                      scenario=self)
+            scenario_run.create_vms(machines, node, addresses)
+        return scenario_run
+
+    def provision(self, users, nodes=None):
+        """Start this scenario for many users at once.
+
+        Users who already have a run for this scenario are skipped. All
+        addresses are allocated in one go and the virtual machines are
+        spread over the nodes, preferring nodes with fewer virtual machines.
+        Only database objects are created, the domains still have to be
+        created by :meth:`ScenarioRun.create_domains` or by the vmd.
+
+        :param users: Iterable of :class:`django.contrib.auth.models.User`.
+        :param nodes: List of nodes to use, defaults to :meth:`get_nodes`.
+        :rtype: List of :class:`insekta.scenario.models.ScenarioRun`.
+        """
+        if not self.enabled:
+            raise ScenarioError('Scenario is not enabled')
 
-        return ScenarioRun.objects.create(vm=vm, user=user, scenario=self)
+        if nodes is None:
+            nodes = self.get_nodes()
+        if not nodes:
+            raise ScenarioError('No nodes available')
+
+        seen = set(ScenarioRun.objects.filter(scenario=self)
+                   .values_list('user', flat=True))
+        new_users = []
+        for user in users:
+            if user.pk not in seen:
+                seen.add(user.pk)
+                new_users.append(user)
+        users = new_users
+        if not users:
+            return []
+
+        # Heap of (number of vms, node) to find the least loaded node
+        node_load = dict((node, 0) for node in nodes)
+        for row in VirtualMachine.objects.filter(node__in=nodes).values(
+                'node').annotate(num_vms=models.Count('pk')):
+            node_load[row['node']] = row['num_vms']
+        load_heap = [(num_vms, node) for node, num_vms in node_load.items()]
+        heapq.heapify(load_heap)
+
+        machines = list(self.machines.all())
+        if not machines:
+            raise ScenarioError('Scenario has no virtual machines')
+        num_machines = len(machines)
+        runs = []
+        with transaction.commit_on_success():
+            addresses = Address.objects.get_free_many(len(users) *
+                                                      num_machines)
+            for i, user in enumerate(users):
+                num_vms, node = heapq.heappop(load_heap)
+                scenario_run = ScenarioRun.objects.create(user=user,
+                                                          scenario=self)
+                scenario_run.create_vms(machines, node, addresses[
+                        i * num_machines:(i + 1) * num_machines])
+                runs.append(scenario_run)
+                heapq.heappush(load_heap, (num_vms + num_machines, node))
+        return runs
 
     def get_run(self, user, fail_silently=False):
         """Return the ScenarioRun for an user if it exists."""
@@ -111,11 +217,26 @@ class Scenario(models.Model):
             if not fail_silently:
                 raise
 
+class ScenarioMachine(models.Model):
+    """A virtual machine that is part of every run of a scenario."""
+    scenario = models.ForeignKey(Scenario, related_name='machines')
+    name = models.CharField(max_length=40)
+    memory = models.IntegerField()
+    image = models.OneToOneField(BaseImage)
+    backend = models.CharField(max_length=10, default='kvm',
+                               choices=BACKEND_CHOICES)
+
+    class Meta:
+        unique_together = (('scenario', 'name'), )
+        ordering = ('id', )
+
+    def __unicode__(self):
+        return u'VM "{0}" of "{1}"'.format(self.name, self.scenario.title)
+
 class ScenarioRun(models.Model):
     scenario = models.ForeignKey(Scenario)
     user = models.ForeignKey(User)
     last_activity = models.DateTimeField(default=datetime.today, db_index=True)
-    vm = models.OneToOneField(VirtualMachine)
 
     class Meta:
         unique_together = (('user', 'scenario'), )
@@ -125,16 +246,166 @@ class ScenarioRun(models.Model):
         return self.last_activity + settings.SCENARIO_EXPIRE_TIME
     
     def heartbeat(self):
-        self.last_activity = datetime.today()
-        self.save()
+        """Mark the run as active.
+
+        The time is put into the cache, which is shared with the vmd. The
+        database is only updated if ``last_activity`` is older than
+        ``SCENARIO_HEARTBEAT_INTERVAL`` seconds, so frequent heartbeats of
+        a run cause one write per interval.
+        """
+        now = datetime.today()
+        expire_time = settings.SCENARIO_EXPIRE_TIME
+        cache.set(_heartbeat_key(self.pk), now,
+                  expire_time.days * 24 * 60 * 60 + expire_time.seconds)
+        interval = timedelta(seconds=getattr(settings,
+                'SCENARIO_HEARTBEAT_INTERVAL', 60))
+        if now - self.last_activity >= interval:
+            ScenarioRun.objects.filter(pk=self.pk).update(last_activity=now)
+        self.last_activity = now
+
+    def create_vms(self, machines, node, addresses):
+        """Create the virtual machines of this run in the database.
+
+        :param machines: List of :class:`ScenarioMachine`.
+        :param node: The node all virtual machines will run on.
+        :param addresses: List of addresses, one for each machine.
+        """
+        for machine, address in zip(machines, addresses):
+            VirtualMachine.objects.create(scenario_run=self,
+                    name=machine.name, node=node, memory=machine.memory,
+                    base_image=machine.image, backend=machine.backend,
+                    address=address)
+
+    def get_vms(self):
+        """Return a list of all virtual machines of this run."""
+        if not hasattr(self, '_vm_cache'):
+            self._vm_cache = list(self.vms.select_related('address')
+                                  .order_by('pk'))
+        return self._vm_cache
+
+    @property
+    def node(self):
+        """The node all virtual machines of this run are running on."""
+        return self.get_vms()[0].node
+
+    @property
+    def state(self):
+        """The common state of all virtual machines.
+
+        If the virtual machines disagree, the state is 'error'.
+        """
+        states = set(vm.state for vm in self.get_vms())
+        if len(states) == 1:
+            return states.pop()
+        return 'error' if states else 'disabled'
+
+    def get_state_display(self):
+        return dict(RUN_STATE_CHOICES).get(self.state, self.state)
+
+    def get_addresses(self):
+        """Return a list of (vm name, ip) tuples."""
+        return [(vm.name, vm.address.ip) for vm in self.get_vms()]
+
+    def refresh_state(self):
+        """Fetch the state of all virtual machines from libvirt."""
+        def refresh(vm):
+            db_state = vm.state
+            vm.refresh_state()
+            if vm.state != db_state:
+                vm.save()
+        parallel_map(refresh, self.get_vms())
+
+    def create_domains(self):
+        """Create and start the domains of all virtual machines."""
+        def create(vm):
+            vm.create_domain()
+            vm.start()
+        parallel_map(create, self.get_vms())
+
+    def start(self):
+        parallel_map(lambda vm: vm.start(), self.get_vms())
+
+    def stop(self):
+        parallel_map(lambda vm: vm.stop(), self.get_vms())
+
+    def suspend(self):
+        parallel_map(lambda vm: vm.suspend(), self.get_vms())
+
+    def resume(self):
+        parallel_map(lambda vm: vm.resume(), self.get_vms())
+
+    def destroy(self):
+        """Destroy all virtual machines and delete this run."""
+        parallel_map(lambda vm: vm.destroy(), self.get_vms())
+        self.delete()
 
     def __unicode__(self):
         return u'{0} running "{1}"'.format(self.user, self.scenario)
 
+def get_last_activities(scenario_runs):
+    """Return the last activity of scenario runs as dictionary by run id.
+
+    Heartbeats that were only recorded in the cache are included, see
+    :meth:`ScenarioRun.heartbeat`.
+    """
+    keys = dict((_heartbeat_key(scenario_run.pk), scenario_run)
+                for scenario_run in scenario_runs)
+    heartbeats = cache.get_many(keys.keys()) if keys else {}
+    last_activities = {}
+    for key, scenario_run in keys.iteritems():
+        last_activities[scenario_run.pk] = max(scenario_run.last_activity,
+                heartbeats.get(key, scenario_run.last_activity))
+    return last_activities
+
+def _heartbeat_key(run_id):
+    return 'run_heartbeat:{0}'.format(run_id)
+
+class RunTaskQueueManager(models.Manager):
+    # Seconds between two checks of the cache while waiting for a task
+    CACHE_INTERVAL = 0.2
+
+    def mark_done(self, task_id):
+        """Tell waiting requests that a task was executed.
+
+        Call it after the task was deleted from the queue.
+        """
+        cache.set('run_task_done:{0}'.format(task_id), True, 5 * 60)
+
+    def is_done(self, task_id):
+        """Return whether a task was executed.
+
+        The cache is checked first, as the vmd marks tasks there. The
+        database is only asked if the task is not marked, e.g. because
+        the cache is not shared between the processes.
+        """
+        if cache.get('run_task_done:{0}'.format(task_id)):
+            return True
+        return not self.get_query_set().filter(pk=task_id).exists()
+
+    def wait_done(self, task_id, timeout):
+        """Wait up to `timeout` seconds until a task was executed.
+
+        Only the cache is checked while waiting, the database is asked once
+        when the time is up, like :meth:`is_done` does. This holds the
+        request, so it needs a worker class that serves other requests
+        meanwhile, like gevent.
+
+        :return: True if the task was executed.
+        """
+        cache_key = 'run_task_done:{0}'.format(task_id)
+        stop_time = time.time() + timeout
+        while time.time() < stop_time:
+            if cache.get(cache_key):
+                return True
+            time.sleep(self.CACHE_INTERVAL)
+        return self.is_done(task_id)
+
 class RunTaskQueue(models.Model):
     scenario_run = models.ForeignKey(ScenarioRun, unique=True)
     action = models.CharField(max_length=10, choices=AVAILABLE_TASKS.items())
 
+    objects = RunTaskQueueManager()
+
     def __unicode__(self):
         return u'{0} for {1}'.format(self.get_action_display(),
                                      unicode(self.scenario_run))
@@ -152,6 +423,7 @@ class Secret(models.Model):
 class SubmittedSecret(models.Model):
     secret = models.ForeignKey(Secret)
     user = models.ForeignKey(User)
+    submitted_at = models.DateTimeField(default=datetime.today)
 
     class Meta:
         unique_together = (('user', 'secret'), )
@@ -179,11 +451,175 @@ class ScenarioBelonging(models.Model):
         return u'{0} belongs to group {1} with rank {2}'.format(unicode(
                 self.scenario), unicode(self.scenario_group), self.rank)
 
+class Scoreboard(models.Model):
+    """Ranking of the users by their submitted secrets.
+
+    There is one global scoreboard without scenario group, counting the
+    secrets of all scenarios, and one for every scenario group. The scores
+    are updated whenever a secret is submitted. The number of users per
+    score is kept as well, so the rank of a user is found by summing up
+    a few rows instead of counting all users with a higher score.
+    """
+    scenario_group = models.OneToOneField(ScenarioGroup, null=True,
+                                          blank=True)
+
+    def __unicode__(self):
+        if self.scenario_group_id is None:
+            return u'Global scoreboard'
+        return u'Scoreboard of {0}'.format(self.scenario_group)
+
+    @classmethod
+    def get_global(cls):
+        return cls.objects.get(scenario_group__isnull=True)
+
+    @classmethod
+    def get_for_scenario(cls, scenario_id):
+        """Return the scoreboards a secret of a scenario counts for."""
+        return cls.objects.filter(models.Q(scenario_group__isnull=True) |
+                models.Q(scenario_group__scenarios=scenario_id))
+
+    def get_top(self, limit):
+        """Return the list of the best `limit` scores.
+
+        Every score gets the attribute ``rank``. Users with the same score
+        share a rank, the user who reached it first is listed first.
+        """
+        scores = list(self.score_set.select_related('user').filter(
+                points__gt=0).order_by('-points', 'last_submission')[:limit])
+        rank = 1
+        for i, score in enumerate(scores):
+            if i and score.points < scores[i - 1].points:
+                rank = i + 1
+            score.rank = rank
+        return scores
+
+    def get_rank(self, user):
+        """Return the rank of a user or None if the user has no score."""
+        try:
+            points = self.score_set.get(user=user).points
+        except Score.DoesNotExist:
+            return None
+        if not points:
+            return None
+        better = self.scorecount_set.filter(points__gt=points).aggregate(
+                models.Sum('num_users'))['num_users__sum']
+        return (better or 0) + 1
+
+    def get_num_users(self):
+        return self.scorecount_set.filter(points__gt=0).aggregate(
+                models.Sum('num_users'))['num_users__sum'] or 0
+
+    def change_score(self, user_id, delta):
+        """Add `delta` to the score of a user.
+
+        Call it inside a transaction, the UPDATE of the score locks it
+        until the score counts are updated as well. Only gained points
+        change the time of the last submission used to break ties.
+        """
+        now = datetime.today()
+        update = {'points': F('points') + delta}
+        if delta > 0:
+            update['last_submission'] = now
+        _update_or_create(Score, {'scoreboard': self, 'user__pk': user_id},
+                update, {'scoreboard': self, 'user_id': user_id,
+                         'points': delta, 'last_submission': now})
+        points = self.score_set.filter(user=user_id).values_list('points',
+                                                                 flat=True)[0]
+        old_points = points - delta
+
+        if old_points > 0:
+            self.scorecount_set.filter(points=old_points).update(
+                    num_users=F('num_users') - 1)
+        if points > 0:
+            _update_or_create(ScoreCount, {'scoreboard': self,
+                                           'points': points},
+                              {'num_users': F('num_users') + 1},
+                              {'scoreboard': self, 'points': points,
+                               'num_users': 1})
+
+    @transaction.commit_on_success
+    def rebuild(self):
+        """Calculate all scores of this scoreboard again.
+
+        Needed after scenarios were added to or removed from the group.
+        """
+        submitted = SubmittedSecret.objects.all()
+        if self.scenario_group_id is not None:
+            submitted = submitted.filter(secret__scenario__groups=
+                                         self.scenario_group_id)
+        points = {}
+        last_submissions = {}
+        for user_id, last_submission, num_secrets in (submitted
+                    .values_list('user').annotate(models.Max('submitted_at'),
+                                              models.Count('pk'))):
+            points[user_id] = num_secrets
+            last_submissions[user_id] = last_submission
+
+        self.score_set.all().delete()
+        self.scorecount_set.all().delete()
+        num_users = {}
+        for user_id, num_secrets in points.iteritems():
+            Score.objects.create(scoreboard=self, user_id=user_id,
+                                 points=num_secrets,
+                                 last_submission=last_submissions[user_id])
+            num_users[num_secrets] = num_users.get(num_secrets, 0) + 1
+        for num_secrets, count in num_users.iteritems():
+            ScoreCount.objects.create(scoreboard=self, points=num_secrets,
+                                      num_users=count)
+
+class Score(models.Model):
+    scoreboard = models.ForeignKey(Scoreboard)
+    user = models.ForeignKey(User)
+    points = models.IntegerField(default=0, db_index=True)
+    last_submission = models.DateTimeField(default=datetime.today)
+
+    class Meta:
+        unique_together = (('scoreboard', 'user'), )
+
+    def __unicode__(self):
+        return u'{0} has {1} points on {2}'.format(self.user, self.points,
+                                                 self.scoreboard)
+
+class ScoreCount(models.Model):
+    """Number of users of a scoreboard with a certain score."""
+    scoreboard = models.ForeignKey(Scoreboard)
+    points = models.IntegerField()
+    num_users = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('scoreboard', 'points'), )
+
+def _update_or_create(model, lookup, update, create):
+    """Update the objects matching `lookup` or create one from `create`.
+
+    `lookup` holds filter arguments, `create` all the field values of the
+    new object, because Django can't filter by `user_id` and the like.
+
+    Unlike get_or_create followed by save, the update is a single UPDATE,
+    so concurrent changes can't overwrite each other. If a concurrent
+    transaction creates the object first, the unique constraint fails
+    and the update is done instead.
+    """
+    queryset = model.objects.filter(**lookup)
+    if queryset.update(**update):
+        return
+    sid = transaction.savepoint()
+    try:
+        model.objects.create(**create)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        queryset.update(**update)
+    else:
+        transaction.savepoint_commit(sid)
+
 class UserProgress(models.Model):
     user = models.ForeignKey(User, db_index=True)
     scenario = models.ForeignKey(Scenario)
     num_secrets = models.IntegerField(default=0)
 
+    class Meta:
+        unique_together = (('user', 'scenario'), )
+
     def __unicode__(self):
         return u'{0} submitted {1} secrets for {1}'.format(self.user,
                 self.num_secrets, self.scenario)
@@ -193,14 +629,72 @@ def calculate_secret_token(user, secret):
     hmac_gen = hmac.new(settings.SECRET_KEY, msg, hashlib.sha1)
     return hmac_gen.hexdigest()
 
-def _update_progress(sender, instance, **kwargs):
-    scenario = instance.secret.scenario
-    num_secrets = SubmittedSecret.objects.filter(user=instance.user,
-            secret__scenario=scenario).aggregate(c=models.Count('secret'))['c']
-    progress, _created = UserProgress.objects.get_or_create(user=instance.user,
-            scenario=scenario)
-    progress.num_secrets = num_secrets
-    progress.save()
-
-post_save.connect(_update_progress, SubmittedSecret)
-post_delete.connect(_update_progress, SubmittedSecret)
+def calculate_secret_tokens(user, secrets):
+    """Return a dictionary mapping the secrets to their security tokens."""
+    return dict((secret, calculate_secret_token(user, secret))
+                for secret in secrets)
+
+def _count_progress(user_id, scenario_id):
+    return SubmittedSecret.objects.filter(user=user_id,
+            secret__scenario=scenario_id).count()
+
+def _update_progress(instance, delta=None):
+    """Update UserProgress.num_secrets and the scores for a submitted secret.
+
+    With a `delta` the counter is changed by a single UPDATE, so concurrent
+    submissions can't overwrite each other. Otherwise it is counted again.
+    """
+    user_id = instance.user_id
+    try:
+        scenario_id = instance.secret.scenario_id
+    except Secret.DoesNotExist:
+        # The secret and with it its scenario is being deleted
+        return
+    progress = UserProgress.objects.filter(user=user_id, scenario=scenario_id)
+
+    if delta is None:
+        progress.update(num_secrets=_count_progress(user_id, scenario_id))
+        return
+
+    if delta > 0:
+        _update_or_create(UserProgress, {'user__pk': user_id,
+                                         'scenario__pk': scenario_id},
+                          {'num_secrets': F('num_secrets') + delta},
+                          {'user_id': user_id, 'scenario_id': scenario_id,
+                           'num_secrets': delta})
+    else:
+        progress.update(num_secrets=F('num_secrets') + delta)
+    for scoreboard in Scoreboard.get_for_scenario(scenario_id):
+        scoreboard.change_score(user_id, delta)
+
+def _submitted_secret_saved(sender, instance, created, **kwargs):
+    _update_progress(instance, 1 if created else None)
+
+def _submitted_secret_deleted(sender, instance, **kwargs):
+    _update_progress(instance, -1)
+
+def _create_scoreboard(sender, instance, created, **kwargs):
+    if created:
+        Scoreboard.objects.create(scenario_group=instance)
+
+def _create_scoreboards(sender, **kwargs):
+    """Create the global scoreboard and those of existing groups."""
+    if not Scoreboard.objects.filter(scenario_group__isnull=True).exists():
+        Scoreboard.objects.create()
+    for scenario_group in ScenarioGroup.objects.filter(
+            scoreboard__isnull=True):
+        Scoreboard.objects.create(scenario_group=scenario_group)
+
+def _invalidate_catalog(sender, **kwargs):
+    # Imported here, the catalog module depends on this one
+    from insekta.scenario.catalog import invalidate
+    invalidate()
+
+for model in (Scenario, Secret, ScenarioGroup, ScenarioBelonging):
+    post_save.connect(_invalidate_catalog, model)
+    post_delete.connect(_invalidate_catalog, model)
+
+post_save.connect(_submitted_secret_saved, SubmittedSecret)
+post_delete.connect(_submitted_secret_deleted, SubmittedSecret)
+post_save.connect(_create_scoreboard, ScenarioGroup)
+post_syncdb.connect(_create_scoreboards, sys.modules[__name__])
@@ -0,0 +1,79 @@
+$(function() {
+    var form = $('form[name="editor_form"]');
+    var preview_url = form.attr('data-preview-url');
+    // Maps the key of a rendered block to its element
+    var shown_blocks = {};
+    var timer = null;
+    var running = false;
+    var pending = false;
+
+    function schedule_preview() {
+        if (timer !== null) {
+            clearTimeout(timer);
+        }
+        timer = setTimeout(request_preview, 500);
+    }
+
+    function request_preview() {
+        timer = null;
+        if (running) {
+            pending = true;
+            return;
+        }
+        running = true;
+
+        var known = [];
+        for (var key in shown_blocks) {
+            known.push(key);
+        }
+        var data = {
+            'content': form.find('[name="content"]').val(),
+            'submitted_secrets': form.find('[name="submitted_secrets"]').val(),
+            'csrfmiddlewaretoken': form.find(
+                    '[name="csrfmiddlewaretoken"]').val(),
+            'known': known
+        };
+        $.post(preview_url, $.param(data, true), update_preview, 'json')
+            .complete(function() {
+                running = false;
+                if (pending) {
+                    pending = false;
+                    request_preview();
+                }
+            });
+    }
+
+    function update_preview(result) {
+        var container = $('#editor_preview .scenario');
+        var new_blocks = {};
+        container.children().detach();
+        $.each(result['blocks'], function(i, key) {
+            var block;
+            if (key in result['fragments']) {
+                block = $('<div class="preview_block" />').html(
+                        result['fragments'][key]);
+            } else if (key in new_blocks) {
+                // The same block occurs several times
+                block = new_blocks[key].clone();
+            } else {
+                block = shown_blocks[key];
+            }
+            new_blocks[key] = block;
+            container.append(block);
+        });
+        shown_blocks = new_blocks;
+
+        var secrets = $('#editor_secrets').empty();
+        if (result['secrets'].length) {
+            var list = $('<ul />').appendTo(secrets);
+            $.each(result['secrets'], function(i, secret) {
+                $('<li />').text(secret).appendTo(list);
+            });
+        } else {
+            $('<p />').text(no_secrets_text).appendTo(secrets);
+        }
+        $('#editor_preview').show();
+    }
+
+    form.find('textarea').bind('keyup change', schedule_preview);
+});
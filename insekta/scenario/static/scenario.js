@@ -15,25 +15,38 @@ $(function() {
             'action': action,
             'csrfmiddlewaretoken': csrf_token    
         }, function(result) {
-            check_new(target_url, result['task_id'])
+            check_new(target_url, result['task_id'], result['poll_delay'])
         }, 'json');
 
         ev.preventDefault();
         ev.stopPropagation();
     }
 
-    function check_new(check_url, task_id) {
-        setTimeout(function() {
-            $.get(check_url, {'task_id': task_id}, function(result, s, xhr) {
+    // The server holds the request until the task is done, if it times
+    // out first we get a 304 and ask again. Servers that can't hold
+    // requests answer at once and tell us how long to wait in between.
+    function check_new(check_url, task_id, poll_delay) {
+        $.ajax({
+            'url': check_url,
+            'data': {'task_id': task_id},
+            'cache': false,
+            'success': function(result, s, xhr) {
                 if (xhr.status == 200) {
                     $('#vm_spinner').hide();
                     $('#scenario_sidebar').html(result).show();
                     register_eventhandler()
                 } else if (xhr.status == 304) {
-                    check_new(check_url, task_id);
+                    setTimeout(function() {
+                        check_new(check_url, task_id, poll_delay);
+                    }, poll_delay);
                 }
-            });
-        }, 1500);
+            },
+            'error': function() {
+                setTimeout(function() {
+                    check_new(check_url, task_id, poll_delay);
+                }, 5000);
+            }
+        });
     }
     
     register_eventhandler();
@@ -5,6 +5,10 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import glob
+import time
+
 from django.test import TestCase
 
 
@@ -14,3 +18,213 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class ExtractSecretsTest(TestCase):
+    texts = [
+        u"<<enterSecret foo 'bar baz'>>Secret?<</enterSecret>>",
+        u'<<enterSecret\n>>no macro<</enterSecret>>',
+        u'<<enterSecret a>>\n<<enterSecret b>>nested<</enterSecret>>\n'
+        u'<</enterSecret>>\n<<enterSecret c>>x<</enterSecret>>',
+        u'{{{<<enterSecret a>>x<</enterSecret>>}}} ~<<enterSecret b>>'
+        u'x<</enterSecret>>',
+        u'{{{\n<<enterSecret a>>\nx\n<</enterSecret>>\n}}}\n',
+        u'<<requireSecret a>>\n<<enterSecret b>>x<</enterSecret>>\n'
+        u'<</requireSecret>>',
+        u'<<enterSecret a>>x\n\ny<</enterSecret>>',
+        u'<<enterSecret a>>x\n= Head =\ny<</enterSecret>>',
+        u'<<enterSecret a=b>>x<</enterSecret>> <<enterSecret c>>',
+        u'<<enterSecret e>>\n<<code python>>\nprint 1\n<</code>>\n'
+        u'<</enterSecret>>text ',
+        u'<<code python>>\nq <<enterSecret a>>x\n<</code>>\n'
+        u'<</enterSecret>>\n<</code>>',
+        u'x <<enterSecret a>>\n<<spoiler>>\n<<enterSecret b>>\ny\n'
+        u'<</enterSecret>>\n<</spoiler>>\n<</enterSecret>>',
+        u'<<codex x=y>>\n* li <<enterSecret l>>\n<</code>>\n'
+        u'<</enterSecret>> y',
+        u'<<spoiler>>\n<<spoiler>>\n<<enterSecret a>>\nx\n<</spoiler>>\n'
+        u'<</enterSecret>>\ny <<enterSecret b>>\n<</enterSecret>>',
+    ]
+
+    def test_same_as_creoleparser(self):
+        from insekta.scenario.markup.parsesecrets import (extract_secrets,
+                _extract_secrets_creole)
+        for text in self.texts:
+            self.assertEqual(extract_secrets(text),
+                             _extract_secrets_creole(text))
+
+    def test_example_scenarios(self):
+        from insekta.scenario.markup.parsesecrets import (extract_secrets,
+                _extract_secrets_creole)
+        examples_dir = os.path.join(os.path.dirname(__file__), '..', '..',
+                                    'examples')
+        filenames = glob.glob(os.path.join(examples_dir, '*',
+                                           'description.creole'))
+        self.assertTrue(filenames)
+        for filename in filenames:
+            with open(filename) as f_description:
+                text = f_description.read().decode('utf-8')
+            self.assertEqual(extract_secrets(text),
+                             _extract_secrets_creole(text))
+
+class HighlightPartsTest(TestCase):
+    texts = [
+        u'Lorem ipsum dolor si amet\n      ^^^^^ ~~~~~    ^^^^\n'
+        u'consectetur adipiscing elit',
+        u'short\n   ^^^^^^ !!',
+        u'a longer line than the markers\n ^^',
+        u'^^^\n  ~~\ntwo marker lines',
+        u'^^ marker on top\n^^',
+    ]
+
+    def test_same_as_reference(self):
+        from insekta.scenario.markup.highlight import (highlight_parts,
+                _highlight_parts_reference)
+        marking = lambda x, c: u'<{0}>{1}</{0}>'.format(c, x)
+        for text in self.texts:
+            self.assertEqual(highlight_parts(text, marking),
+                             _highlight_parts_reference(text, marking))
+
+class SplitBlocksTest(TestCase):
+    def test_keeps_block_macros_together(self):
+        from insekta.scenario.markup.preview import split_blocks
+        text = (u'First\nparagraph\n\n<<ip>>\n\n<<spoiler>>\nhidden\n\n'
+                u'text\n<</spoiler>>\n\n{{{\ncode\n\n}}}\n\nLast')
+        self.assertEqual(split_blocks(text), [
+            u'First\nparagraph',
+            u'<<ip>>',
+            u'<<spoiler>>\nhidden\n\ntext\n<</spoiler>>',
+            u'{{{\ncode\n\n}}}',
+            u'Last'
+        ])
+
+    def test_block_secrets(self):
+        from insekta.scenario.markup.preview import (split_blocks,
+                                                     extract_block_secrets)
+        text = (u'<<enterSecret a>>\nx\n<</enterSecret>>\n\nText\n\n'
+                u'<<spoiler>>\n<<enterSecret b>>y<</enterSecret>>\n\n'
+                u'<</spoiler>>')
+        blocks = split_blocks(text)
+        self.assertEqual(extract_block_secrets(blocks), set(['a', 'b']))
+        # The second call takes the secrets from the cache
+        self.assertEqual(extract_block_secrets(blocks), set(['a', 'b']))
+
+class ScoreboardTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from insekta.scenario.models import (Scenario, Secret, ScenarioGroup,
+                                             ScenarioBelonging)
+        self.scenario = Scenario.objects.create(name='test', title='Test',
+                description='', num_secrets=2)
+        for secret in ('a', 'b'):
+            Secret.objects.create(scenario=self.scenario, secret=secret)
+        self.group = ScenarioGroup.objects.create(title='Group')
+        ScenarioBelonging.objects.create(scenario=self.scenario,
+                scenario_group=self.group, rank=1)
+        self.users = [User.objects.create(username='user{0}'.format(i))
+                      for i in range(3)]
+
+    def test_ranks(self):
+        from insekta.scenario.models import Scoreboard
+        alice, bob, carol = self.users
+        self.scenario.submit_secret(alice, 'a')
+        self.scenario.submit_secret(bob, 'a')
+        self.scenario.submit_secret(bob, 'b')
+
+        for scoreboard in (Scoreboard.get_global(),
+                           Scoreboard.objects.get(scenario_group=self.group)):
+            top = scoreboard.get_top(10)
+            self.assertEqual([(s.user, s.points, s.rank) for s in top],
+                             [(bob, 2, 1), (alice, 1, 2)])
+            self.assertEqual(scoreboard.get_rank(alice), 2)
+            self.assertEqual(scoreboard.get_rank(carol), None)
+            self.assertEqual(scoreboard.get_num_users(), 2)
+
+        self.scenario.submit_secret(alice, 'b')
+        scoreboard = Scoreboard.get_global()
+        self.assertEqual(scoreboard.get_rank(alice), 1)
+        self.assertEqual(scoreboard.get_rank(bob), 1)
+
+    def test_removed_points_keep_tie_break(self):
+        from insekta.scenario.models import Scoreboard, SubmittedSecret
+        alice, bob, carol = self.users
+        for user in (alice, bob):
+            self.scenario.submit_secret(user, 'a')
+            self.scenario.submit_secret(user, 'b')
+        for user in (bob, alice):
+            SubmittedSecret.objects.get(user=user, secret__secret='b').delete()
+
+        top = Scoreboard.get_global().get_top(10)
+        self.assertEqual([(s.user, s.points) for s in top],
+                         [(alice, 1), (bob, 1)])
+
+class RunTaskQueueTest(TestCase):
+    def test_wait_done(self):
+        from insekta.scenario.models import RunTaskQueue
+        # Tasks no longer in the queue were executed
+        self.assertTrue(RunTaskQueue.objects.wait_done(1, 0))
+        RunTaskQueue.objects.mark_done(2)
+        start = time.time()
+        self.assertTrue(RunTaskQueue.objects.wait_done(2, 10))
+        self.assertTrue(time.time() - start < 1)
+
+class HeartbeatTest(TestCase):
+    def test_last_activities(self):
+        from datetime import datetime, timedelta
+        from django.contrib.auth.models import User
+        from insekta.scenario.models import (Scenario, ScenarioRun,
+                                             get_last_activities)
+        scenario = Scenario.objects.create(name='test', title='Test',
+                description='', num_secrets=0)
+        user = User.objects.create(username='user')
+        long_ago = datetime.today() - timedelta(days=1)
+        scenario_run = ScenarioRun.objects.create(scenario=scenario,
+                user=user, last_activity=long_ago)
+
+        scenario_run.heartbeat()
+        heartbeat = scenario_run.last_activity
+        stored_run = ScenarioRun.objects.get(pk=scenario_run.pk)
+        self.assertEqual(stored_run.last_activity, heartbeat)
+
+        # Within the interval only the cache is updated
+        scenario_run.heartbeat()
+        stored_run = ScenarioRun.objects.get(pk=scenario_run.pk)
+        self.assertEqual(stored_run.last_activity, heartbeat)
+        self.assertEqual(get_last_activities([stored_run]),
+                         {scenario_run.pk: scenario_run.last_activity})
+
+class OverlayTest(TestCase):
+    texts = [
+        u"<<requireSecret 'a' 'b'>>Congratulation!<</requireSecret>>\n\n"
+        u"<<requireSecret 'a'>>\n<<requireSecret 'b'>>\nBoth\n"
+        u"<</requireSecret>>\n<</requireSecret>>",
+        u'x <<requireSecret a>>text <<ip>><</requireSecret>> y',
+        u'<<requireSecret b>>\nq <<enterSecret a>>\n y \n<</enterSecret>>\n'
+        u'<</requireSecret>>',
+        u'= Head =\n<<enterSecret a>>x <<requireSecret b>>//y//'
+        u'<</requireSecret>><</enterSecret>>\n{{{\ncode\n}}}\n<<ip pivot>>',
+    ]
+
+    def test_same_as_full_render(self):
+        from insekta.scenario.models import Scenario
+        from insekta.scenario.markup.creole import render_scenario
+        from insekta.scenario.markup.overlay import render_cached
+        for i, text in enumerate(self.texts):
+            scenario = Scenario(name='overlay{0}'.format(i),
+                                description=text)
+            for submitted in (set(), set(['a']), set(['b']),
+                              set(['a', 'b'])):
+                environ = {
+                    'ip': '10.0.0.2',
+                    'ips': {'pivot': '10.0.0.6'},
+                    'user': None,
+                    'enter_secret_target': '/secret',
+                    'submitted_secrets': submitted,
+                    'all_secrets': ['a', 'b'],
+                    'secret_token_function': lambda user, s: 'token-' + s,
+                    'csrf_token': 'csrf'
+                }
+                full = render_scenario(text, environ=dict(environ))
+                if isinstance(full, str):
+                    full = full.decode('utf-8')
+                self.assertEqual(render_cached(scenario, dict(environ)),
+                                 full)
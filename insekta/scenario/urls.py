@@ -4,10 +4,14 @@ urlpatterns = patterns('insekta.scenario.views',
    url(r'^$', 'scenario_home', name='scenario.home'),
    url(r'^groups$', 'scenario_groups', name='scenario.groups'),
    url(r'^all$', 'all_scenarios', name='scenario.all'),
+   url(r'^scoreboard$', 'scoreboard', name='scenario.scoreboard'),
+   url(r'^scoreboard/(\d+)$', 'scoreboard',
+       name='scenario.group_scoreboard'),
    url(r'^show/([\w-]+)$', 'show_scenario', name='scenario.show'),
    url(r'^manage_vm/([\w-]+)$', 'manage_vm', name='scenario.manage_vm'),
    url(r'^heartbeat/([\w-]+)$', 'heartbeat', name='scenario.heartbeat'),
    url(r'^submit_secret/([\w-]+)$', 'submit_secret',
        name='scenario.submit_secret'),
    url(r'^editor$', 'editor', name='scenario.editor'),
+   url(r'^editor/preview$', 'editor_preview', name='scenario.editor_preview'),
 )
@@ -1,7 +1,9 @@
-from operator import attrgetter
+import json
+import copy
 
 from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
+from django.conf import settings
 from django.http import (HttpResponse, HttpResponseBadRequest,
                          HttpResponseNotModified)
 from django.utils.translation import ugettext as _
@@ -11,16 +13,22 @@ from django.contrib import messages
 from django.middleware.csrf import get_token
 from django import forms
 from django.views.decorators.http import require_POST
+from django.db import transaction
 
-from insekta.common.dblock import dblock
-from insekta.scenario.models import (Scenario, ScenarioRun, RunTaskQueue,
-                                     ScenarioGroup, ScenarioBelonging,
-                                     UserProgress, InvalidSecret,
+from insekta.common.dblock import dblock, LockTimeout
+from insekta.scenario.models import (ScenarioRun, RunTaskQueue, UserProgress,
+                                     Scoreboard, InvalidSecret,
                                      calculate_secret_token, AVAILABLE_TASKS)
-from insekta.scenario.markup.creole import render_scenario
-from insekta.scenario.markup.parsesecrets import extract_secrets
+from insekta.scenario.markup.overlay import render_cached
+from insekta.scenario.markup.preview import (split_blocks, render_blocks,
+                                             extract_block_secrets)
+from insekta.scenario.catalog import get_catalog, get_enabled_scenario
 
 LOCK_RUN_TASK_QUEUE = 298437
+# Seconds a request waits for another one enqueuing a task for the same run
+RUN_TASK_LOCK_TIMEOUT = 5
+# Milliseconds between two task status requests if they are not held open
+TASK_POLL_DELAY = 1500
 
 @login_required
 def scenario_home(request):
@@ -34,35 +42,18 @@ def scenario_home(request):
 @login_required
 def scenario_groups(request):
     """Show an overview of the scenarios in groups."""
-
+    # The catalog is shared, so attributes are attached to copies
     all_scenarios = []
-
-    # Build a dctionary for scenario groups with pk as key.
-    # Attach attribute scenario_list to scenario group
-    groups = {}
-    for scenario_group in ScenarioGroup.objects.all():
-        scenario_group.scenario_list = []
-        groups[scenario_group.pk] = scenario_group
-
-    # Attach attribute "rank" to scenarios and put them into
-    # scenario group's scenario_list
-    for belonging in  ScenarioBelonging.objects.select_related('scenario'):
-        scenario = belonging.scenario
-        if not scenario.enabled:
-            continue
-        scenario_list = groups[belonging.scenario_group.pk].scenario_list
-        scenario.rank = belonging.rank
-        scenario_list.append(scenario)
-        all_scenarios.append(scenario)
-
-    # Sort all scenario_lists by rank
-    for group in groups.itervalues():
-        group.scenario_list.sort(key=attrgetter('rank'))
+    group_list = []
+    for scenario_group, scenario_list in get_catalog().groups:
+        scenario_group = copy.copy(scenario_group)
+        scenario_group.scenario_list = [copy.copy(scenario) for scenario
+                                        in scenario_list]
+        all_scenarios.extend(scenario_group.scenario_list)
+        group_list.append(scenario_group)
     
     _attach_user_progress(all_scenarios, request.user)
 
-    group_list = groups.values()
-    group_list.sort(key=attrgetter('title'))
     return TemplateResponse(request, 'scenario/groups.html', {
         'scenario_group_list': group_list
     })
@@ -70,56 +61,77 @@ def scenario_groups(request):
 @login_required
 def all_scenarios(request):
     """Show all scenarios as list."""
-    scenarios = list(Scenario.objects.filter(enabled=True).order_by('title'))
+    scenarios = [copy.copy(scenario) for scenario
+                 in get_catalog().get_enabled_scenarios()]
     return TemplateResponse(request, 'scenario/all.html', {
         'scenario_list': _attach_user_progress(scenarios, request.user) 
     })
 
 def _attach_user_progress(scenarios, user):
     """Attach attribute 'num_submitted_secrets' to all scenarios."""
-    user_progress = {}
-    for progress in UserProgress.objects.select_related('scenario').filter(
-                user=user):
-        user_progress[progress.scenario.pk] = progress.num_secrets
+    user_progress = dict(UserProgress.objects.filter(user=user).values_list(
+            'scenario', 'num_secrets'))
 
     for scenario in scenarios:
         scenario.num_submitted_secrets = user_progress.get(scenario.pk, 0)
 
     return scenarios
 
+@login_required
+def scoreboard(request, scenario_group_id=None):
+    """Show the best users and the rank of the current user."""
+    if scenario_group_id is None:
+        board = get_object_or_404(Scoreboard, scenario_group__isnull=True)
+    else:
+        board = get_object_or_404(Scoreboard,
+                                  scenario_group=scenario_group_id)
+
+    return TemplateResponse(request, 'scenario/scoreboard.html', {
+        'scoreboard': board,
+        'score_list': board.get_top(getattr(settings, 'SCOREBOARD_SIZE', 50)),
+        'user_rank': board.get_rank(request.user),
+        'num_users': board.get_num_users(),
+        'scoreboard_list': Scoreboard.objects.select_related(
+                'scenario_group').order_by('scenario_group__title')
+    })
+
 @login_required
 def show_scenario(request, scenario_name):
     """Shows the description of a scenario."""
-    scenario = get_object_or_404(Scenario, name=scenario_name, enabled=True)
+    catalog = get_catalog()
+    scenario = get_enabled_scenario(scenario_name)
 
     try:
         scenario_run = ScenarioRun.objects.get(user=request.user,
                                                scenario=scenario)
-        vm = scenario_run.vm
-        vm_state = vm.state
-        ip = vm.address.ip
+        vm_state = scenario_run.state
+        addresses = scenario_run.get_addresses()
         expiry = scenario_run.expires_at
     except ScenarioRun.DoesNotExist:
         vm_state = 'disabled'
-        ip = None
+        addresses = []
         expiry = None
 
     environ = {
-        'ip': ip,
+        'ip': addresses[0][1] if addresses else None,
+        'ips': dict(addresses),
         'user': request.user,
         'enter_secret_target': reverse('scenario.submit_secret',
                                        args=(scenario_name, )),
         'submitted_secrets': scenario.get_submitted_secrets(request.user),
-        'all_secrets': scenario.get_secrets(),
+        'all_secrets': catalog.get_secrets(scenario),
         'secret_token_function': calculate_secret_token,
+        # Copied, the render adds the tokens of unknown secrets
+        'secret_tokens': dict(catalog.get_secret_tokens(request.user,
+                                                        scenario)),
         'csrf_token': get_token(request)
 
     }
     return TemplateResponse(request, 'scenario/show.html', {
         'scenario': scenario,
-        'description': render_scenario(scenario.description, environ=environ),
+        'description': render_cached(scenario, environ),
         'vm_state': vm_state,
-        'ip': ip,
+        'addresses': addresses,
         'expiry': expiry,
         'num_submitted_secrets': _get_num_submitted_secrets(scenario,
                 request.user)
@@ -127,31 +139,38 @@ def show_scenario(request, scenario_name):
 
 @login_required
 def manage_vm(request, scenario_name):
-    scenario = get_object_or_404(Scenario, name=scenario_name, enabled=True)
+    # GET will wait until the action was executed. The request is held
+    # open if the workers can serve other requests meanwhile, otherwise
+    # it is answered at once and the client asks again.
+    wait_timeout = getattr(settings, 'SCENARIO_TASK_WAIT_TIMEOUT', 0)
+    if request.method == 'GET' and 'task_id' in request.GET:
+        try:
+            task_id = int(request.GET['task_id'])
+        except ValueError:
+            return HttpResponseBadRequest('Invalid task id')
+        if not RunTaskQueue.objects.wait_done(task_id, wait_timeout):
+            return HttpResponseNotModified()
+
+    scenario = get_enabled_scenario(scenario_name)
     
     try:
         scenario_run = ScenarioRun.objects.get(user=request.user,
                                                scenario=scenario)
-        vm = scenario_run.vm
     except ScenarioRun.DoesNotExist:
         if request.method == 'POST':
             scenario_run = scenario.start(request.user)
         else:
             scenario_run = None
    
-    # GET will check whether the action was executed
     if request.method == 'GET' and 'task_id' in request.GET:
-        task_id = request.GET['task_id']
-        if not RunTaskQueue.objects.filter(pk=task_id).count():
-            return TemplateResponse(request, 'scenario/sidebar.html', {
-                'scenario': scenario,
-                'vm_state': vm.state if scenario_run else 'disabled',
-                'ip': vm.address.ip if scenario_run else None,
-                'num_submitted_secrets': _get_num_submitted_secrets(scenario,
-                        request.user)
-            })
-        else:
-            return HttpResponseNotModified()
+        return TemplateResponse(request, 'scenario/sidebar.html', {
+            'scenario': scenario,
+            'vm_state': scenario_run.state if scenario_run else 'disabled',
+            'addresses': scenario_run.get_addresses() if scenario_run
+                         else [],
+            'num_submitted_secrets': _get_num_submitted_secrets(scenario,
+                    request.user)
+        })
     # while POST asks the daemon to execute the action
     elif request.method == 'POST':
         action = request.POST.get('action')
@@ -166,15 +185,26 @@ def manage_vm(request, scenario_name):
         # everything will work fine
         
        
-        with dblock(LOCK_RUN_TASK_QUEUE):
-            try:
-                task = RunTaskQueue.objects.get(scenario_run=scenario_run)
-            except RunTaskQueue.DoesNotExist:
-                task = RunTaskQueue.objects.create(scenario_run=scenario_run,
-                                                   action=action)
+        # Only requests for the same run wait for each other. The lock is
+        # released after the task is committed.
+        try:
+            with dblock(LOCK_RUN_TASK_QUEUE, scenario_run.pk,
+                        timeout=RUN_TASK_LOCK_TIMEOUT):
+                with transaction.commit_on_success():
+                    try:
+                        task = RunTaskQueue.objects.get(
+                                scenario_run=scenario_run)
+                    except RunTaskQueue.DoesNotExist:
+                        task = RunTaskQueue.objects.create(
+                                scenario_run=scenario_run, action=action)
+        except LockTimeout:
+            return HttpResponse(status=503)
+
         if request.is_ajax():
-            return HttpResponse('{{"task_id": {0}}}'.format(task.pk),
-                                mimetype='application/x-json')
+            return HttpResponse(json.dumps({
+                'task_id': task.pk,
+                'poll_delay': 0 if wait_timeout else TASK_POLL_DELAY
+            }), mimetype='application/x-json')
         else:
             messages.success(request, _('Task was received and will be executed.'))
     
@@ -183,7 +213,7 @@ def manage_vm(request, scenario_name):
 @require_POST
 @login_required
 def heartbeat(request, scenario_name):
-    scenario = get_object_or_404(Scenario, name=scenario_name, enabled=True)
+    scenario = get_enabled_scenario(scenario_name)
     try:
         scenario.get_run(request.user).heartbeat()
     except ScenarioRun.DoesNotExist:
@@ -200,7 +230,7 @@ def _get_num_submitted_secrets(scenario, user):
 
 @login_required
 def submit_secret(request, scenario_name):
-    scenario = get_object_or_404(Scenario, name=scenario_name, enabled=True)
+    scenario = get_enabled_scenario(scenario_name)
     try:
         scenario.get_run(request.user).heartbeat()
     except ScenarioRun.DoesNotExist:
@@ -208,7 +238,7 @@ def submit_secret(request, scenario_name):
 
     try:
         scenario.submit_secret(request.user, request.POST.get('secret'),
-                               request.POST.getlist('secret_token'))
+                               set(request.POST.getlist('secret_token')))
     except InvalidSecret, e:
         messages.error(request, unicode(e))
     else:
@@ -216,35 +246,44 @@ def submit_secret(request, scenario_name):
 
     return redirect(reverse('scenario.show', args=(scenario_name, )))
 
+class EditorForm(forms.Form):
+    submitted_secrets = forms.CharField(label=_('Submitted secrets:'),
+            widget=forms.Textarea(attrs={'cols': 35, 'rows': 5}),
+            required=False)
+    content = forms.CharField(label=_('Content:'),
+            widget=forms.Textarea(attrs={'cols': 80, 'rows': 30}),
+            required=False)
+
+def _render_preview(request, data, known_keys=()):
+    """Render the preview of the editor block by block.
+
+    :return: Tuple of all secrets, the block keys and the rendered blocks,
+             see :func:`insekta.scenario.markup.preview.render_blocks`.
+    """
+    blocks = split_blocks(data['content'])
+    secrets = extract_block_secrets(blocks)
+    environ = {
+        'submitted_secrets': [secret.strip() for secret in
+                              data['submitted_secrets'].splitlines()],
+        'all_secrets': secrets,
+        'secret_token_function': calculate_secret_token,
+        'user': request.user,
+        'enter_secret_target': 'javascript:return false;',
+        'csrf_token': ''
+    }
+    keys, fragments = render_blocks(blocks, environ, known_keys)
+    return secrets, keys, fragments
+
 @login_required
 @permission_required('scenario.view_editor')
 def editor(request):
-    class EditorForm(forms.Form):
-        submitted_secrets = forms.CharField(label=_('Submitted secrets:'),
-                widget=forms.Textarea(attrs={'cols': 35, 'rows': 5}),
-                required=False)
-        content = forms.CharField(label=_('Content:'),
-                widget=forms.Textarea(attrs={'cols': 80, 'rows': 30}),
-                required=False)
-
-    def parse_secrets(secrets):
-        return [secret.strip() for secret in secrets.splitlines()]
-
     secrets = None
     if request.method == 'POST':
         editor_form = EditorForm(request.POST)
         if editor_form.is_valid():
-            data = editor_form.cleaned_data
-            secrets = extract_secrets(data['content'])
-            environ = {
-                'submitted_secrets': parse_secrets(data['submitted_secrets']),
-                'all_secrets': secrets,
-                'secret_token_function': calculate_secret_token,
-                'user': request.user,
-                'enter_secret_target': 'javascript:return false;',
-                'csrf_token': ''
-            }
-            preview = render_scenario(data['content'], environ=environ)
+            secrets, keys, fragments = _render_preview(request,
+                    editor_form.cleaned_data)
+            preview = u''.join(fragments[key] for key in keys)
         else:
             preview = None
     else:
@@ -257,3 +296,24 @@ def editor(request):
         'secrets': secrets
     })
 
+@require_POST
+@login_required
+@permission_required('scenario.view_editor')
+def editor_preview(request):
+    """Render the changed blocks of the editor's content.
+
+    The client posts the keys of the blocks it already shows as ``known``.
+    The response contains the keys of all blocks in document order, but
+    only the html of the other blocks.
+    """
+    editor_form = EditorForm(request.POST)
+    if not editor_form.is_valid():
+        return HttpResponseBadRequest('Invalid editor content')
+
+    secrets, keys, fragments = _render_preview(request,
+            editor_form.cleaned_data, request.POST.getlist('known'))
+    return HttpResponse(json.dumps({
+        'blocks': keys,
+        'fragments': fragments,
+        'secrets': sorted(secrets)
+    }), mimetype='application/x-json')
@@ -4,7 +4,7 @@ from django.db.models.signals import post_delete
 from django.template.loader import render_to_string
 import libvirt
 
-from insekta.common.virt import connections
+from insekta.common.virt import connections, lxc_connections
 from insekta.network.models import Address
 
 RUN_STATE_CHOICES = (
@@ -16,6 +16,16 @@ RUN_STATE_CHOICES = (
     ('error', 'VM has weird error')
 )
 
+BACKEND_CHOICES = (
+    ('kvm', 'KVM virtual machine'),
+    ('lxc', 'LXC container')
+)
+
+_DOMAIN_TEMPLATES = {
+    'kvm': 'vm/domain.xml',
+    'lxc': 'vm/lxc_domain.xml'
+}
+
 class VirtualMachineError(Exception):
     pass
 
@@ -47,8 +57,9 @@ class BaseImage(models.Model):
 
     def __unicode__(self):
         try:
-            scenario = self.scenario
-            return u'Image for "{0}"'.format(scenario.title)
+            machine = self.scenariomachine
+            return u'Image of VM "{0}" for "{1}"'.format(machine.name,
+                                                        machine.scenario.title)
         except:
             if not self.virtualmachine_set.count():
                 return u'No longer used'
@@ -56,17 +67,25 @@ class BaseImage(models.Model):
                 return u'Deprecated image, but still in use'
 
 class VirtualMachine(models.Model):
+    scenario_run = models.ForeignKey('scenario.ScenarioRun',
+                                     related_name='vms')
+    name = models.CharField(max_length=40)
     memory = models.IntegerField()
     base_image = models.ForeignKey(BaseImage)
     node = models.CharField(max_length=80)
+    backend = models.CharField(max_length=10, default='kvm',
+                               choices=BACKEND_CHOICES)
     address = models.OneToOneField(Address)
     state = models.CharField(max_length=10, default='disabled',
                              choices=RUN_STATE_CHOICES)
 
+    class Meta:
+        unique_together = (('scenario_run', 'name'), )
+
     def __unicode__(self):
-        scenario_run = self.scenariorun
-        return u'VM for scenario "{0}" played by {1}'.format(
-                scenario_run.scenario.title,
+        scenario_run = self.scenario_run
+        return u'VM "{0}" for scenario "{1}" played by {2}'.format(
+                self.name, scenario_run.scenario.title,
                 scenario_run.user.username)
 
     def start(self):
@@ -86,7 +105,7 @@ class VirtualMachine(models.Model):
         self._do_vm_action('resume', 'started')
 
     def destroy(self):
-        """Destroy this scenario run including virtual machine."""
+        """Destroy this virtual machine including its domain."""
         try:
             self.stop()
         except VirtualMachineError:
@@ -128,7 +147,7 @@ class VirtualMachine(models.Model):
         """
         volume = self._create_volume()
         xml_desc = self._build_domain_xml(volume)
-        domain = connections[self.node].defineXML(xml_desc)
+        domain = self.get_connection().defineXML(xml_desc)
         self.state = 'stopped'
         self.save()
         return domain
@@ -149,12 +168,24 @@ class VirtualMachine(models.Model):
         self._do_vm_action('undefine', 'disabled')
         self.get_volume().delete(flags=0)
 
+    def get_connection(self):
+        """Return the libvirt connection for this virtual machine's backend.
+
+        LXC containers are defined through the node's LXC driver, the
+        volumes are still managed through the default connection.
+
+        :rtype: :class:`libvirt.virConnect`.
+        """
+        if self.backend == 'lxc':
+            return lxc_connections[self.node]
+        return connections[self.node]
+
     def get_domain(self):
         """Return the domain of this scenario run.
 
         :rtype: :class:`libvirt.virDomain`.
         """
-        conn = connections[self.node]
+        conn = self.get_connection()
         return conn.lookupByName('scenarioRun{0}'.format(self.pk))
 
     def get_volume(self):
@@ -185,8 +216,9 @@ class VirtualMachine(models.Model):
         return pool.createXML(xmldesc, flags=0)
     
     def _build_domain_xml(self, volume):
-        scenario_run = self.scenariorun
-        return render_to_string('vm/domain.xml', {
+        scenario_run = self.scenario_run
+        return render_to_string(_DOMAIN_TEMPLATES[self.backend], {
+            'name': self.name,
             'id': self.pk,
             'user': scenario_run.user,
             'scenario': scenario_run.scenario,
@@ -225,4 +257,10 @@ def _delete_image(sender, instance, **kwargs):
         except libvirt.libvirtError:
             pass
 
+def _release_address(sender, instance, **kwargs):
+    # Runs for every way a virtual machine is deleted, including the
+    # deletion of its scenario run
+    Address.objects.release([instance.address_id])
+
 post_delete.connect(_delete_image, BaseImage)
+post_delete.connect(_release_address, VirtualMachine)